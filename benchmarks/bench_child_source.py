@@ -0,0 +1,109 @@
+"""
+Micro-benchmark comparing :py:func:`sphinx_parsed_codeblock.sphinx_parsed_codeblock.build_child_source`
+and :py:func:`sphinx_parsed_codeblock.sphinx_parsed_codeblock.build_children_source` against the
+original implementation, which popped the output from the body one fragment at a time.
+
+The markup elements used are deeply nested inline elements, each of which produces many fragments.
+
+Run with::
+
+    python benchmarks/bench_child_source.py
+"""
+from __future__ import annotations
+
+import timeit
+
+from docutils import nodes
+from docutils.frontend import get_default_settings
+from docutils.utils import new_document
+from docutils.writers.html5_polyglot import HTMLTranslator, Writer
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import build_child_source, build_children_source
+
+
+def legacy_build_child_source(visitor: HTMLTranslator, child: nodes.Node) -> str:
+    """The original implementation of `build_child_source`, kept for comparison."""
+    i = len(visitor.body)
+    child.walkabout(visitor)
+    try:
+        source = visitor.body.pop(i)
+    except IndexError:
+        return ''
+
+    for j in range(i+1, len(visitor.body)+1):
+        source += visitor.body.pop(i)
+
+    return source
+
+
+def make_translator() -> HTMLTranslator:
+    document = new_document('benchmark', get_default_settings(Writer))
+    return HTMLTranslator(document)
+
+
+def make_nested(depth: int) -> nodes.Node:
+    """Creates inline markup nested ``depth`` levels deep, e.g. ``*a **b ``c``** d*``."""
+    node = nodes.literal('', 'innermost')
+    types = (nodes.emphasis, nodes.strong, nodes.inline)
+    for i in range(depth):
+        node = types[i % len(types)]('', f'{i} ', node, nodes.Text(f' {i}'))
+    return node
+
+
+class Fragments(nodes.inline):
+    """
+    Inline element that outputs pre-made HTML fragments when walked, so that only the cost of
+    capturing the output is measured.
+    """
+    def walkabout(self, visitor: HTMLTranslator) -> bool:
+        visitor.body.extend(self['fragments'])
+        return False
+
+
+def time_cases(translator: HTMLTranslator, children: list[nodes.Node], repeat: int) -> dict:
+    expected = [legacy_build_child_source(translator, child) for child in children]
+    assert [build_child_source(translator, child) for child in children] == expected
+    assert build_children_source(translator, children) == expected
+
+    cases = {
+        'legacy': lambda: [legacy_build_child_source(translator, child) for child in children],
+        'current': lambda: [build_child_source(translator, child) for child in children],
+        'batch': lambda: build_children_source(translator, children),
+    }
+    timings = {name: float('inf') for name in cases}
+
+    # Interleave the runs so that all implementations are equally affected by any noise
+    for _ in range(repeat):
+        for name, case in cases.items():
+            timings[name] = min(timings[name], timeit.timeit(case, number=1))
+
+    for name, value in timings.items():
+        print(f'{name:>10}: {value * 1000:.2f} ms')
+
+    return timings
+
+
+def main(depths: tuple[int, ...] = (10, 100, 500),
+         n_fragments: tuple[int, ...] = (100, 1000, 10000),
+         n_children: int = 20,
+         repeat: int = 5) -> dict:
+    translator = make_translator()
+    results = {'nested': {}, 'fragments': {}}
+
+    for depth in depths:
+        print(f'nested markup: depth {depth} ({2 * depth + 3} fragments per element, '
+              f'{n_children} elements)')
+        children = [make_nested(depth) for _ in range(n_children)]
+        results['nested'][depth] = time_cases(translator, children, repeat)
+
+    for n in n_fragments:
+        print(f'capture only: {n} fragments per element, {n_children} elements')
+        fragments = [f'<span class="f{i}">' if i % 2 else '</span>' for i in range(n)]
+        children = [Fragments('', fragments=fragments) for _ in range(n_children)]
+        results['fragments'][n] = time_cases(translator, children, repeat)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark comparing :py:class:`sphinx_parsed_codeblock.sphinx_parsed_codeblock.PygmentsLineState`
+against the original, regex-based implementation.
+
+Run with::
+
+    python benchmarks/bench_line_state.py
+"""
+from __future__ import annotations
+
+import re
+import timeit
+
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import PygmentsLineState
+
+
+class LegacyPygmentsLineState:
+    """The regex-based implementation of `PygmentsLineState`, kept for comparison."""
+    def __init__(self, line: str):
+        self._span_iterator = re.finditer(r'(<span.*?>)(.*?)</span>', line)
+        self.html_span, self.text, self.html_close = self.__next__()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[str, str, str]:
+        html_span, text = next(self._span_iterator).groups()
+        split = re.match(r'(.*?)(</.*>)', text)
+        if split is None:
+            html_close = r'</span>'
+        else:
+            text, html_close = split.groups()
+            html_close += r'</span>'
+
+        open = ''.join(re.findall(r'<.*?>', text))
+        text = text.replace(open, '')
+        html_span += open
+
+        return html_span, text, html_close
+
+    def next(self) -> None:
+        self.html_span, self.text, self.html_close = self.__next__()
+
+    def cut(self, n: int) -> None:
+        self.html_span = ''
+        self.text = self.text[n:]
+
+    def restore_span(self) -> str:
+        return self.html_span + self.text + self.html_close
+
+
+YAML_TEMPLATE = '''\
+section_{0}:
+    string: "string {0}"
+    number: {0}
+    list: [1, 2, 3, 4, {0}]
+    bool: true
+    none: null
+'''
+
+
+def make_lines(n_sections: int = 500) -> list[str]:
+    """Creates Pygments-formatted YAML lines, as seen by `MarkupHtmlFormatter`."""
+    source = ''.join(YAML_TEMPLATE.format(i) for i in range(n_sections))
+    html = highlight(source, get_lexer_by_name('yaml'), HtmlFormatter(nowrap=True))
+    return [line + '\n' for line in html.splitlines() if '<span' in line]
+
+
+def consume(cls: type, lines: list[str]) -> None:
+    """Walks over every element of every line, the way `MarkupHtmlFormatter` does."""
+    for line in lines:
+        state = cls(line)
+        state.restore_span()
+        while True:
+            try:
+                state.next()
+            except StopIteration:
+                break
+            state.cut(1)
+            state.restore_span()
+
+
+def main(repeat: int = 7, number: int = 5) -> dict[str, float]:
+    lines = make_lines()
+    classes = {'legacy': LegacyPygmentsLineState, 'current': PygmentsLineState}
+    results = {name: float('inf') for name in classes}
+
+    # Interleave the runs so that both implementations are equally affected by any noise
+    for _ in range(repeat):
+        for name, cls in classes.items():
+            time = timeit.timeit(lambda: consume(cls, lines), number=number) / number
+            results[name] = min(results[name], time)
+
+    print(f'{len(lines)} lines')
+    for name, value in results.items():
+        print(f'{name:>10}: {value * 1000:.2f} ms')
+    print(f'{"speed-up":>10}: {results["legacy"] / results["current"]:.2f}x')
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
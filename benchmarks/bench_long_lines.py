@@ -0,0 +1,157 @@
+"""
+Benchmark of :py:class:`sphinx_parsed_codeblock.sphinx_parsed_codeblock.MarkupHtmlFormatter` on
+single very long lines, e.g. minified JSON, from 1 KB to 1 MB.
+
+The time per KB is reported for both engines, and for the original implementation of the
+``'lines'`` engine, which sliced and concatenated the text instead of moving a cursor through it
+and was therefore quadratic. If the formatter scales linearly, the time per KB stays roughly
+constant as the lines get longer.
+
+Run with::
+
+    python benchmarks/bench_long_lines.py
+"""
+from __future__ import annotations
+
+import timeit
+
+from docutils import nodes
+from docutils.frontend import get_default_settings
+from docutils.utils import new_document
+from docutils.writers.html5_polyglot import HTMLTranslator, Writer
+import pygments
+from pygments.lexers import get_lexer_by_name
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import (
+    build_children_source, markup_intervals, MarkupHtmlFormatter, parse_complex_sphinx_source,
+    parsed_code_block, PygmentsLineState
+)
+
+
+class LegacyMarkupHtmlFormatter(MarkupHtmlFormatter):
+    """`MarkupHtmlFormatter` with the original, quadratic, text matching, kept for comparison."""
+    @staticmethod
+    def _handle_text_line(sphinx_text: str,
+                          pygments_state: PygmentsLineState,
+                          new_line: list[str]) -> list[str] | None:
+        while True:
+            if not sphinx_text:
+                break
+
+            if sphinx_text.startswith(pygments_state.text):
+                sphinx_text = sphinx_text[len(pygments_state.text):]
+                new_line.append(pygments_state.restore_span())
+                pygments_state.next()
+                continue
+
+            if pygments_state.text.startswith(sphinx_text):
+                new_line.append(pygments_state.html_span + sphinx_text)
+                pygments_state.cut(len(sphinx_text))
+                break
+            else:
+                return None
+        return new_line
+
+    @staticmethod
+    def _handle_markup_over_multiple_elements(sphinx_text: str,
+                                              sphinx_markup: str,
+                                              pygments_state: PygmentsLineState,
+                                              new_line: list[str]
+                                              ) -> bool | None:
+        temp_line = [pygments_state.restore_span()]
+        matches = pygments_state.text
+        for _, text, _ in pygments_state.iter():
+            temp_line.append(pygments_state.restore_span())
+            matches += text
+
+            if matches == sphinx_text:
+                break
+        else:
+            return False
+
+        try:
+            start, end = sphinx_markup.split(''.join(matches))
+        except ValueError:
+            start, end = parse_complex_sphinx_source(sphinx_markup, matches)
+
+        new_line.append(start)
+        new_line.extend(temp_line)
+        new_line.append(end)
+
+
+def make_line(size: int, link_every: int) -> parsed_code_block:
+    """
+    Creates a code block with a single line of minified JSON of roughly ``size`` characters, in
+    which every ``link_every``-th value is a link, as well as the very last value. If
+    ``link_every`` is 0, only the last value is a link.
+    """
+    # Consecutive text is kept in a single node, the same as when parsed from reStructuredText
+    children, text = [], ['{']
+    length, i = 1, 0
+    while length < size:
+        key = f'"key{i}":'
+        value = f'"value{i}"'
+        if link_every and i % link_every == link_every - 1:
+            children.append(nodes.Text(''.join(text) + key))
+            children.append(nodes.reference(value, value, refuri=f'#value{i}'))
+            text = [',']
+        else:
+            text.append(f'{key}{value},')
+        length += len(key) + len(value) + 1
+        i += 1
+
+    children.append(nodes.Text(''.join(text) + '"end":'))
+    children.append(nodes.reference('null', 'null', refuri='#end'))
+    children.append(nodes.Text('}'))
+
+    return parsed_code_block('', '', *children, language='json')
+
+
+def main(sizes: tuple[int, ...] = (1_000, 10_000, 100_000, 1_000_000),
+         link_every: tuple[int, ...] = (10, 1000, 0),
+         legacy_max: int = 100_000,
+         repeat: int = 3) -> dict:
+    translator = HTMLTranslator(new_document('benchmark', get_default_settings(Writer)))
+    lexer = get_lexer_by_name('json')
+    formatters = {
+        'tokens': lambda node, markup: MarkupHtmlFormatter(node, translator, 'tokens', markup=markup),
+        'lines': lambda node, markup: MarkupHtmlFormatter(node, translator, 'lines', markup=markup),
+        'legacy': lambda node, markup: LegacyMarkupHtmlFormatter(node, translator, 'lines',
+                                                                 markup=markup),
+    }
+
+    results = {}
+    for every in link_every:
+        print(f'a link every {every} values' if every else 'a single link at the end')
+        results[every] = {}
+        for size in sizes:
+            node = make_line(size, every)
+            source = node.astext()
+            markup = build_children_source(translator, [c for _, _, c in markup_intervals(node)])
+
+            cases = {name: formatter for name, formatter in formatters.items()
+                     if name != 'legacy' or size <= legacy_max}
+            expected = pygments.highlight(source, lexer, formatters['tokens'](node, markup))
+            timings = {name: float('inf') for name in cases}
+
+            # Interleave the runs so that all implementations are equally affected by any noise
+            for _ in range(repeat):
+                for name, formatter in cases.items():
+                    def run():
+                        return pygments.highlight(source, lexer, formatter(node, markup))
+
+                    timings[name] = min(timings[name], timeit.timeit(run, number=1))
+
+            assert all(pygments.highlight(source, lexer, formatter(node, markup)) == expected
+                       for formatter in cases.values())
+
+            per_kb = ', '.join(f'{name} {value / len(source) * 1e6:8.1f} ms/KB'
+                               for name, value in timings.items())
+            print(f'{len(source):>10} characters: {per_kb}')
+            results[every][size] = timings
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
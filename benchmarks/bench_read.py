@@ -0,0 +1,158 @@
+"""
+Benchmark of the read phase of a project with many ``parsed-code-block``, comparing the directive
+against its original implementation, which first ran the ``code-block`` directive and then
+converted the `literal_block` it created into a `parsed_code_block`, and against not parsing the
+code blocks at all (see ``parsed_codeblock_lazy_builders``).
+
+The builds use the ``dummy`` builder, which does not write anything. Since the rest of the read
+phase is the same for all the cases and much noisier, the time spent in the directive itself is
+reported separately, as is the total size of the pickled doctrees.
+
+The runs of all the cases are interleaved and each is repeated; the best time is reported together
+with the range of the directive times, and the ratio of the best directive time to that of the
+original implementation. The absolute times can vary considerably between invocations, so only
+the ratios measured within one invocation should be compared.
+
+Run with::
+
+    python benchmarks/bench_read.py
+"""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from io import StringIO
+from pathlib import Path
+import shutil
+import tempfile
+from time import perf_counter
+
+from docutils import nodes
+from sphinx.directives.code import CodeBlock
+from sphinx.testing.util import SphinxTestApp
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import parsed_code_block, ParsedCodeBlock
+
+from corpus import make_corpus, write_project
+
+try:
+    # Sphinx < 7.2 requires its own path type
+    from sphinx.testing.path import path as sphinx_path
+except ImportError:
+    sphinx_path = Path
+
+
+def legacy_run(self: ParsedCodeBlock) -> list[nodes.Node]:
+    """The original implementation of `ParsedCodeBlock.run`, kept for comparison."""
+    text_nodes, messages = self.state.inline_text('\n'.join(self.content), self.lineno)
+    node = CodeBlock.run(self)[0]
+
+    container = None
+    if self.options.get('caption'):
+        container = node
+        node = next(child for child in container.children
+                    if isinstance(child, nodes.literal_block))
+
+    if all(isinstance(text_node, nodes.Text) for text_node in text_nodes):
+        text = ''.join(text_node.astext() for text_node in text_nodes)
+        custom_node = nodes.literal_block(text, text, **node.attributes)
+    else:
+        custom_node = parsed_code_block(node.rawsource, '', *text_nodes, **node.attributes)
+    custom_node.source, custom_node.line = node.source, node.line
+
+    for node_id in custom_node['ids']:
+        if self.state.document.ids.get(node_id) is node:
+            self.state.document.ids[node_id] = custom_node
+
+    if container is not None:
+        node.replace_self(custom_node)
+        return [container]
+
+    return [custom_node]
+
+
+@contextmanager
+def timed_directive(run) -> list[float]:
+    """Replaces `ParsedCodeBlock.run` with ``run``, timing each call."""
+    timings = []
+
+    def timed_run(self):
+        start = perf_counter()
+        try:
+            return run(self)
+        finally:
+            timings.append(perf_counter() - start)
+
+    original = ParsedCodeBlock.run
+    ParsedCodeBlock.run = timed_run
+    try:
+        yield timings
+    finally:
+        ParsedCodeBlock.run = original
+
+
+def read(srcdir: Path, builddir: Path, run, lazy: bool = False) -> tuple[float, float, int]:
+    """
+    Reads all the documents of the project from scratch, returning the total time and the time
+    spent in the directive, in seconds, and the size of the doctrees, in bytes.
+    """
+    shutil.rmtree(builddir, ignore_errors=True)
+    confoverrides = {'parsed_codeblock_lazy_builders': ['dummy']} if lazy else None
+    app = SphinxTestApp('dummy', srcdir=sphinx_path(srcdir), builddir=sphinx_path(builddir),
+                        confoverrides=confoverrides, status=StringIO(), warning=StringIO())
+    try:
+        with timed_directive(run) as timings:
+            start = perf_counter()
+            app.build(force_all=True)
+            total = perf_counter() - start
+    finally:
+        app.cleanup()
+
+    size = sum(path.stat().st_size for path in Path(app.doctreedir).glob('**/*.doctree'))
+    return total, sum(timings), size
+
+
+def add_options(srcdir: Path) -> None:
+    """Gives every code block a caption, a name and emphasized lines."""
+    index = srcdir / 'index.rst'
+    blocks = index.read_text(encoding='utf-8').split('.. parsed-code-block:: yaml\n')
+    index.write_text(''.join(
+        [blocks[0]] + [f'.. parsed-code-block:: yaml\n    :caption: Block {i}\n    :name: block-{i}\n'
+                       f'    :emphasize-lines: 1\n{block}' for i, block in enumerate(blocks[1:])]
+    ), encoding='utf-8')
+
+
+def main(scale: float = 1.0, repeat: int = 7) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for name, options in (('plain', False), ('options', True)):
+            srcdir = write_project(tmp / name, make_corpus('small', scale=scale))
+            if options:
+                add_options(srcdir)
+
+            cases = {'current': (ParsedCodeBlock.run, False), 'legacy': (legacy_run, False),
+                     'lazy': (ParsedCodeBlock.run, True)}
+            runs = {case: [] for case in cases}
+            # Interleave the runs so that all the cases are equally affected by any noise
+            for _ in range(repeat):
+                for case, (run, lazy) in cases.items():
+                    runs[case].append(read(srcdir, tmp / 'build', run, lazy))
+
+            timings = {case: [min(values) for values in zip(*case_runs)]
+                       for case, case_runs in runs.items()}
+            legacy = timings['legacy'][1]
+
+            print(f'{name} (best of {repeat})')
+            for case, (total, directive, size) in timings.items():
+                directives = [run[1] for run in runs[case]]
+                print(f'{case:>10}: directive {directive * 1000:8.1f} ms '
+                      f'({min(directives) * 1000:.1f}-{max(directives) * 1000:.1f}, '
+                      f'{directive / legacy:.2f}x legacy), read phase {total * 1000:8.1f} ms, '
+                      f'doctrees {size / 2 ** 20:6.2f} MiB')
+            results[name] = timings
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark of the peak memory of rendering a very large `parsed_code_block`, with and without
+streaming its HTML into the body of the translator (see ``parsed_codeblock_stream_threshold``).
+
+The HTML written into the body is the output of the build and is the same in both cases, so it is
+reported separately from the overhead on top of it: without streaming, the whole HTML is also held
+by a `io.StringIO` and then copied once more when it is appended to the body.
+
+Run with::
+
+    python benchmarks/bench_streaming.py
+"""
+from __future__ import annotations
+
+import tracemalloc
+
+from sphinx.highlighting import PygmentsBridge
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import (
+    BodyWriter, highlight_parsed_block, markup_intervals
+)
+
+from corpus import block_to_node, make_corpus
+
+
+def measure(node, markup: list[str], stream: bool, chunk_size: int) -> tuple[int, int]:
+    """Renders the code block, returning the peak memory and the size of the body, in bytes."""
+    bridge = PygmentsBridge('html')
+    source = node.astext()
+    body = ['<div>']
+
+    tracemalloc.start()
+    try:
+        if stream:
+            writer = BodyWriter(body, chunk_size)
+            highlight_parsed_block(bridge, node, None, source, 'yaml', markup=markup, outfile=writer)
+            writer.flush()
+            body.append('</div>')
+        else:
+            highlighted = highlight_parsed_block(bridge, node, None, source, 'yaml', markup=markup)
+            body.append(body.pop() + highlighted + '</div>')
+            del highlighted
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak, size
+
+
+def main(scale: float = 1.0, chunk_sizes: tuple[int, ...] = (100, 1000, 10_000)) -> dict:
+    node = block_to_node(make_corpus('large', scale=scale)[0])
+    markup = [f'<em>{child.astext()}</em>' for _, _, child in markup_intervals(node)]
+    print(f'{node.astext().count(chr(10)) + 1} lines, {len(markup)} markup elements')
+
+    results = {}
+    for name, stream, chunk_size in [('buffered', False, 0)] + [(f'stream {size}', True, size)
+                                                                 for size in chunk_sizes]:
+        peak, size = measure(node, markup, stream, chunk_size)
+        results[name] = {'peak': peak, 'body': size}
+        print(f'{name:>14}: peak {peak / 2 ** 20:8.2f} MiB, of which {(peak - size) / 2 ** 20:8.2f} '
+              f'MiB above the output')
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Reproducible synthetic corpora for the benchmarks.
+
+Each corpus is a list of code blocks, and each code block is a list of segments - either plain text
+or a ``(role, text)`` tuple for a piece of markup. The same corpus can therefore be turned into
+reStructuredText (both as ``parsed-code-block`` and as a plain ``code-block``) as well as directly
+into `parsed_code_block` nodes, without going through the parser.
+
+All corpora are generated from a seeded random number generator, so the same ``seed`` and
+``scale`` always produce the same corpus.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+import random
+from typing import Union
+
+from docutils import nodes
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import parsed_code_block
+
+
+Segment = Union[str, tuple[str, str]]
+
+ROLES = ('emphasis', 'strong', 'reference')
+
+
+@dataclass
+class Scenario:
+    """
+    The shape of a corpus.
+
+    Parameters
+    ----------
+    name
+        The name of the corpus.
+    description
+        A short description of the corpus, for the report.
+    n_blocks
+        The number of code blocks.
+    n_lines
+        The number of lines in each code block.
+    items_per_line
+        The number of values on each line. More than one makes a flow-style YAML list.
+    markup_ratio
+        The fraction of the values that are marked up.
+    """
+    name: str
+    description: str
+    n_blocks: int
+    n_lines: int
+    items_per_line: int
+    markup_ratio: float
+
+    def scaled(self, scale: float) -> Scenario:
+        """Returns a copy of the scenario with its largest dimension scaled by ``scale``."""
+        n_blocks, n_lines, items = self.n_blocks, self.n_lines, self.items_per_line
+        if n_blocks >= max(n_lines, items):
+            n_blocks = max(1, round(n_blocks * scale))
+        elif n_lines >= items:
+            n_lines = max(1, round(n_lines * scale))
+        else:
+            items = max(1, round(items * scale))
+
+        return Scenario(self.name, self.description, n_blocks, n_lines, items, self.markup_ratio)
+
+
+SCENARIOS = {
+    scenario.name: scenario for scenario in [
+        Scenario('small', 'many small blocks', 2000, 5, 1, 0.2),
+        Scenario('large', 'a few 50k-line blocks', 2, 50_000, 1, 0.1),
+        Scenario('long_line', 'single very long lines', 5, 1, 20_000, 0.02),
+        Scenario('dense', 'dense markup', 200, 50, 1, 1.0),
+        Scenario('no_markup', 'blocks without any markup', 500, 20, 1, 0.0),
+        Scenario('sparse', 'markup on a few lines of large blocks', 20, 2000, 1, 0.01),
+    ]
+}
+
+
+def make_value(rng: random.Random, i: int, markup_ratio: float) -> Segment:
+    """Creates a single YAML value, marked up with probability ``markup_ratio``."""
+    text = f'value{i}x{rng.randrange(1000)}'
+    if rng.random() < markup_ratio:
+        return rng.choice(ROLES), text
+    return text
+
+
+def make_block(rng: random.Random, scenario: Scenario) -> list[Segment]:
+    """Creates the segments of a single YAML code block."""
+    segments = []
+    for i in range(scenario.n_lines):
+        segments.append(f'key{i}: ')
+        if scenario.items_per_line == 1:
+            segments.append(make_value(rng, i, scenario.markup_ratio))
+        else:
+            segments.append('[')
+            for j in range(scenario.items_per_line):
+                if j:
+                    segments.append(', ')
+                segments.append(make_value(rng, j, scenario.markup_ratio))
+            segments.append(']')
+        segments.append('\n')
+
+    segments[-1] = ''
+    return segments
+
+
+def make_corpus(name: str, seed: int = 0, scale: float = 1.0) -> list[list[Segment]]:
+    """
+    Generates a corpus.
+
+    Parameters
+    ----------
+    name
+        The name of the scenario, one of `SCENARIOS`.
+    seed
+        The seed of the random number generator.
+    scale
+        Factor by which to scale the size of the corpus, e.g. ``0.01`` for a quick run.
+
+    Returns
+    -------
+    corpus
+        The code blocks, each a list of segments.
+    """
+    scenario = SCENARIOS[name].scaled(scale)
+    rng = random.Random(f'{name}-{seed}')
+    return [make_block(rng, scenario) for _ in range(scenario.n_blocks)]
+
+
+def segment_to_rst(segment: Segment) -> str:
+    if isinstance(segment, str):
+        return segment
+
+    role, text = segment
+    if role == 'emphasis':
+        return f'*{text}*'
+    elif role == 'strong':
+        return f'**{text}**'
+    return f'`{text} <https://example.com/{text}>`_'
+
+
+def segment_to_node(segment: Segment) -> nodes.Node:
+    if isinstance(segment, str):
+        return nodes.Text(segment)
+
+    role, text = segment
+    if role == 'emphasis':
+        return nodes.emphasis(text, text)
+    elif role == 'strong':
+        return nodes.strong(text, text)
+    return nodes.reference(text, text, refuri=f'https://example.com/{text}')
+
+
+def block_to_text(block: list[Segment]) -> str:
+    """Returns the plain text of a code block, i.e. what a plain ``code-block`` would contain."""
+    return ''.join(segment if isinstance(segment, str) else segment[1] for segment in block)
+
+
+def block_to_node(block: list[Segment], language: str = 'yaml') -> parsed_code_block:
+    """Creates the `parsed_code_block` node that the directive would create for a code block."""
+    children = [segment_to_node(segment) for segment in block if segment]
+    return parsed_code_block('', '', *children, language=language)
+
+
+def corpus_to_rst(corpus: list[list[Segment]], parsed: bool = True, language: str = 'yaml') -> str:
+    """
+    Creates a reStructuredText document containing all the code blocks of a corpus.
+
+    Parameters
+    ----------
+    corpus
+        The code blocks.
+    parsed
+        Whether to use ``parsed-code-block``, or a plain ``code-block`` without any markup.
+    language
+        The language of the code blocks.
+
+    Returns
+    -------
+    document
+        The reStructuredText document.
+    """
+    directive = 'parsed-code-block' if parsed else 'code-block'
+    out = ['Benchmark\n=========\n']
+    for block in corpus:
+        if parsed:
+            text = ''.join(segment_to_rst(segment) for segment in block)
+        else:
+            text = block_to_text(block)
+
+        out.append(f'.. {directive}:: {language}\n')
+        out.extend(f'    {line}' for line in text.split('\n'))
+        out.append('')
+
+    return '\n'.join(out) + '\n'
+
+
+def write_project(srcdir: Path, corpus: list[list[Segment]], parsed: bool = True) -> Path:
+    """
+    Writes a Sphinx project containing a corpus into ``srcdir``.
+
+    Parameters
+    ----------
+    srcdir
+        The source directory of the project. Created if it does not exist.
+    corpus
+        The code blocks.
+    parsed
+        Whether to use ``parsed-code-block``, or a plain ``code-block`` without any markup.
+
+    Returns
+    -------
+    srcdir
+        The source directory.
+    """
+    srcdir.mkdir(parents=True, exist_ok=True)
+    (srcdir / 'conf.py').write_text("extensions = ['sphinx_parsed_codeblock']\n", encoding='utf-8')
+    (srcdir / 'index.rst').write_text(corpus_to_rst(corpus, parsed), encoding='utf-8')
+    return srcdir
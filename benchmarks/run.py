@@ -0,0 +1,246 @@
+"""
+Benchmark suite for the parsed-code-block rendering pipeline.
+
+For each of the synthetic corpora in :py:mod:`corpus` (many small blocks, a few 50k-line blocks,
+single very long lines, dense markup, no markup at all and sparse markup), this times:
+
+* ``split_parsed_codeblock`` - splitting the nodes into their text and markup,
+* ``build_child_source`` - rendering each markup element into HTML,
+* ``pygments`` - highlighting the plain text with the stock Pygments formatter (the baseline),
+* ``formatter_<engine>`` - highlighting with ``MarkupHtmlFormatter``, for each engine,
+* ``build_code_block`` - a full Sphinx HTML build of the corpus as plain ``code-block``,
+* ``build_parsed_code_block`` - a full Sphinx HTML build of the corpus as ``parsed-code-block``,
+* ``build_prerender`` - the same build with ``parsed_codeblock_prerender`` enabled,
+
+and reports the overhead of ``MarkupHtmlFormatter`` and of the full build relative to a plain
+``code-block``. The results can be saved as JSON and compared against a previous run to catch
+regressions between releases.
+
+Run with::
+
+    python benchmarks/run.py --scale 0.1 --output results.json
+    python benchmarks/run.py --scale 0.1 --compare results.json
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import datetime, timezone
+from io import StringIO
+import json
+from pathlib import Path
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from typing import Callable
+
+import docutils
+from docutils.frontend import get_default_settings
+from docutils.utils import new_document
+from docutils.writers.html5_polyglot import HTMLTranslator, Writer
+import pygments
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+import sphinx
+from sphinx.testing.util import SphinxTestApp
+
+from sphinx_parsed_codeblock.sphinx_parsed_codeblock import (
+    build_child_source, markup_intervals, MarkupHtmlFormatter, split_parsed_codeblock
+)
+
+from corpus import block_to_node, block_to_text, make_corpus, SCENARIOS, write_project
+
+try:
+    # Sphinx < 7.2 requires its own path type
+    from sphinx.testing.path import path as sphinx_path
+except ImportError:
+    sphinx_path = Path
+
+
+ENGINES = ('tokens', 'lines')
+
+
+def time_cases(cases: dict[str, Callable[[], object]], repeat: int) -> dict[str, float]:
+    """
+    Times each case, returning the best of ``repeat`` runs.
+
+    The runs are interleaved, so that all the cases are equally affected by any noise.
+    """
+    timings = {name: float('inf') for name in cases}
+    for _ in range(repeat):
+        for name, case in cases.items():
+            timings[name] = min(timings[name], timeit.timeit(case, number=1))
+
+    return timings
+
+
+def make_translator() -> HTMLTranslator:
+    document = new_document('benchmark', get_default_settings(Writer))
+    return HTMLTranslator(document)
+
+
+def build(srcdir: Path, builddir: Path, confoverrides: dict | None = None) -> None:
+    """Runs a full Sphinx HTML build from scratch."""
+    shutil.rmtree(builddir, ignore_errors=True)
+    app = SphinxTestApp('html', srcdir=sphinx_path(srcdir), builddir=sphinx_path(builddir),
+                        confoverrides=confoverrides, status=StringIO(), warning=StringIO())
+    try:
+        app.build(force_all=True)
+    finally:
+        app.cleanup()
+
+
+def bench_pipeline(corpus: list, repeat: int) -> dict[str, float]:
+    """Times the individual parts of the rendering pipeline."""
+    nodes = [block_to_node(block) for block in corpus]
+    texts = [block_to_text(block) for block in corpus]
+    translator = make_translator()
+    children = [child for node in nodes for _, _, child in markup_intervals(node)]
+    markup = [[build_child_source(translator, child) for _, _, child in markup_intervals(node)]
+              for node in nodes]
+    lexer = get_lexer_by_name('yaml')
+
+    def highlight_markup(engine: str) -> Callable[[], list[str]]:
+        return lambda: [pygments.highlight(text, lexer, MarkupHtmlFormatter(node, translator, engine,
+                                                                           markup=node_markup))
+                        for node, text, node_markup in zip(nodes, texts, markup)]
+
+    cases = {
+        'split_parsed_codeblock': lambda: [list(split_parsed_codeblock(node)) for node in nodes],
+        'build_child_source': lambda: [build_child_source(translator, child) for child in children],
+        'pygments': lambda: [pygments.highlight(text, lexer, HtmlFormatter()) for text in texts],
+    }
+    for engine in ENGINES:
+        cases[f'formatter_{engine}'] = highlight_markup(engine)
+
+    return time_cases(cases, repeat)
+
+
+def bench_build(corpus: list, repeat: int) -> dict[str, float]:
+    """Times full Sphinx builds of the corpus, with and without markup."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        plain = write_project(tmp / 'plain', corpus, parsed=False)
+        parsed = write_project(tmp / 'parsed', corpus, parsed=True)
+
+        return time_cases({
+            'build_code_block': lambda: build(plain, tmp / 'plain_build'),
+            'build_parsed_code_block': lambda: build(parsed, tmp / 'parsed_build'),
+            'build_prerender': lambda: build(parsed, tmp / 'prerender_build',
+                                             {'parsed_codeblock_prerender': True}),
+        }, repeat)
+
+
+def run(scenarios: list[str], scale: float, seed: int, repeat: int, builds: bool) -> dict:
+    """
+    Runs the benchmarks.
+
+    Returns
+    -------
+    results
+        The metadata of the run and the timings, in seconds, of each benchmark for each scenario,
+        together with the overheads relative to a plain code-block.
+    """
+    results = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sphinx': sphinx.__version__,
+            'pygments': pygments.__version__,
+            'docutils': docutils.__version__,
+            'scale': scale,
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'scenarios': {},
+    }
+
+    for name in scenarios:
+        scenario = SCENARIOS[name].scaled(scale)
+        print(f'{name}: {scenario.description} ({scenario.n_blocks} blocks x {scenario.n_lines} '
+              f'lines x {scenario.items_per_line} values, markup ratio {scenario.markup_ratio})')
+
+        corpus = make_corpus(name, seed, scale)
+        timings = bench_pipeline(corpus, repeat)
+        if builds:
+            timings.update(bench_build(corpus, repeat))
+
+        overhead = {engine: timings[f'formatter_{engine}'] / timings['pygments']
+                    for engine in ENGINES}
+        if builds:
+            overhead['build'] = timings['build_parsed_code_block'] / timings['build_code_block']
+
+        for benchmark, value in timings.items():
+            print(f'{benchmark:>25}: {value * 1000:10.2f} ms')
+        for benchmark, value in overhead.items():
+            print(f'{"overhead " + benchmark:>25}: {value:10.2f}x')
+
+        results['scenarios'][name] = {'timings': timings, 'overhead': overhead}
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compares the timings and overheads against a previous run.
+
+    The overheads are relative to the same run, so they are comparable even between runs on
+    different machines.
+
+    Returns
+    -------
+    regressions
+        A description of each benchmark that is slower than in ``baseline`` by more than
+        ``tolerance`` (as a fraction).
+    """
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        for kind, unit, factor in (('timings', 'ms', 1000), ('overhead', 'x', 1)):
+            old = baseline['scenarios'].get(name, {}).get(kind, {})
+            for benchmark, value in scenario[kind].items():
+                if benchmark in old and value > old[benchmark] * (1 + tolerance):
+                    regressions.append(f'{name}/{kind}/{benchmark}: {old[benchmark] * factor:.2f} '
+                                       f'{unit} -> {value * factor:.2f} {unit} '
+                                       f'({value / old[benchmark]:.2f}x)')
+
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f'the scenarios to run, any of {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='factor by which to scale the size of the corpora')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the corpus generator')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each benchmark')
+    parser.add_argument('--no-build', dest='builds', action='store_false',
+                        help='skip the full Sphinx builds')
+    parser.add_argument('--output', type=Path, help='file to save the results to, as JSON')
+    parser.add_argument('--compare', type=Path, help='results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown (as a fraction) tolerated by --compare')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    results = run(args.scenarios or list(SCENARIOS), args.scale, args.seed, args.repeat, args.builds)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text(encoding='utf-8'))
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
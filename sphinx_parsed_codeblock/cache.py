@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from hashlib import sha256
+import os
+from pathlib import Path
+import tempfile
+from typing import Hashable, TypeVar
+
+from sphinx.util import logging
+
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class DiskCache:
+    """
+    Content-addressed cache of strings, stored as files on disk.
+
+    Each value is stored in its own file, named after its key, so that the cache can be safely
+    shared by multiple processes (e.g. the parallel write workers of ``sphinx-build -j N``): values
+    are written to a temporary file first and then atomically moved into place, so a reader will
+    only ever see a complete value or no value at all.
+
+    The cache is bounded in size by evicting the least recently used values - reading a value
+    updates the modification time of its file, and :py:meth:`evict` removes the files with the
+    oldest modification times.
+
+    Parameters
+    ----------
+    directory
+        The directory in which to store the cache. Created if it does not exist.
+    max_size
+        The maximum total size of the cache, in bytes.
+    """
+    suffix = '.cache'
+
+    def __init__(self, directory: str | os.PathLike, max_size: int):
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(*parts: object) -> str:
+        """
+        Creates a key by hashing all the ``parts``.
+
+        Parameters
+        ----------
+        *parts
+            Anything that has a stable ``repr``, e.g. strings, numbers and tuples or sorted lists of
+            them.
+
+        Returns
+        -------
+        key
+            The hex digest of the hash.
+        """
+        digest = sha256()
+        for part in parts:
+            digest.update(repr(part).encode('utf-8', 'surrogatepass'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / (key + self.suffix)
+
+    def get(self, key: str) -> str | None:
+        """
+        Retrieves a value from the cache.
+
+        Parameters
+        ----------
+        key
+            The key of the value, see :py:meth:`make_key`.
+
+        Returns
+        -------
+        value
+            The cached value, or ``None`` if it is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            value = path.read_text(encoding='utf-8')
+            os.utime(path)
+        except OSError:
+            return None
+
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores a value in the cache.
+
+        Failing to do so is not an error - the value simply will not be cached.
+
+        Parameters
+        ----------
+        key
+            The key of the value, see :py:meth:`make_key`.
+        value
+            The value to store.
+        """
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(value)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError as e:
+            LOGGER.debug(f'sphinx-parsed-codeblock: could not write to cache: {e}')
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used values until the cache fits within its maximum size.
+
+        Returns
+        -------
+        n_evicted
+            The number of values removed.
+        """
+        entries = []
+        total = 0
+        for path in self.directory.glob('*/*' + self.suffix):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        n_evicted = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            n_evicted += 1
+
+        return n_evicted
+
+
+class LRUCache:
+    """
+    In-memory cache bounded in the number of values, evicting the least recently used ones.
+
+    Parameters
+    ----------
+    max_size
+        The maximum number of values to keep.
+
+    Attributes
+    ----------
+    hits
+        The number of times a value was found in the cache.
+    misses
+        The number of times a value was not found in the cache.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: T = None) -> object | T:
+        """
+        Retrieves a value from the cache, marking it as recently used.
+
+        Parameters
+        ----------
+        key
+            The key of the value.
+        default
+            The value to return if ``key`` is not in the cache.
+
+        Returns
+        -------
+        value
+            The cached value, or ``default``.
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: object) -> None:
+        """
+        Stores a value in the cache, evicting the least recently used value if the cache is full.
+
+        Parameters
+        ----------
+        key
+            The key of the value.
+        value
+            The value to store.
+        """
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes all values from the cache, keeping the counters."""
+        self._data.clear()
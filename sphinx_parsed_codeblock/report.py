@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+from contextvars import ContextVar
+import csv
+from dataclasses import asdict, dataclass, fields
+import json
+import os
+from pathlib import Path
+
+from sphinx.util import logging
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class BlockRecord:
+    """
+    Performance statistics of rendering a single `parsed_code_block`.
+
+    Parameters
+    ----------
+    document
+        The document containing the code block.
+    line
+        The line of the code block in the document.
+    lexer
+        The name of the Pygments lexer used. Empty if the rendered block was reused (see ``cached``).
+    lines
+        The number of lines of the code block.
+    markup
+        The number of markup elements in the code block.
+    markup_time
+        The time taken rendering the markup elements into HTML, in seconds.
+    merge_time
+        The time taken highlighting the code block and merging in the markup, in seconds.
+    fallbacks
+        The number of times the markup had to be stripped from (a part of) the code block.
+    cached
+        Whether the rendered block was reused, either from an identical code block rendered earlier
+        in the build or from the on-disk cache.
+    """
+    document: str
+    line: int | None
+    lexer: str = ''
+    lines: int = 0
+    markup: int = 0
+    markup_time: float = 0.0
+    merge_time: float = 0.0
+    fallbacks: int = 0
+    cached: bool = False
+
+    @property
+    def time(self) -> float:
+        """The total time taken rendering the code block, in seconds."""
+        return self.markup_time + self.merge_time
+
+
+CURRENT_RECORD: ContextVar[BlockRecord | None] = ContextVar('parsed_codeblock_record', default=None)
+"""The record of the code block currently being rendered, if a report is being made."""
+
+
+def warn_fallback(message: str) -> None:
+    """
+    Warns that markup had to be stripped from a code block, counting it in the current record.
+
+    Parameters
+    ----------
+    message
+        The warning message, without the prefix of the extension.
+    """
+    LOGGER.warning('sphinx-parsed-codeblock: ' + message)
+
+    record = CURRENT_RECORD.get()
+    if record is not None:
+        record.fallbacks += 1
+
+
+class BuildReport:
+    """
+    Collects `BlockRecord` of all the code blocks rendered during a build and writes them into a
+    report.
+
+    The records are first appended to a file per process, so that the code blocks rendered by the
+    parallel write workers of ``sphinx-build -j N`` are recorded too, and are merged into the
+    report by :py:meth:`write` at the end of the build.
+
+    Parameters
+    ----------
+    directory
+        The directory in which to store the records and the report. Created if it does not exist.
+    format
+        The format of the report, either ``'json'`` or ``'csv'``.
+    """
+    suffix = '.jsonl'
+    name = 'parsed_codeblock_report'
+
+    def __init__(self, directory: str | os.PathLike, format: str = 'json'):
+        self.directory = Path(directory)
+        self.format = format
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.glob('*' + self.suffix):
+            path.unlink()
+
+    def add(self, record: BlockRecord) -> None:
+        """
+        Stores a record of a rendered code block.
+
+        Parameters
+        ----------
+        record
+            The record to store.
+        """
+        path = self.directory / f'{os.getpid()}{self.suffix}'
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(asdict(record)) + '\n')
+
+    def collect(self) -> list[BlockRecord]:
+        """
+        Reads the records stored by all the processes and removes them from the disk.
+
+        Returns
+        -------
+        records
+            All the records, slowest code block first.
+        """
+        records = []
+        for path in self.directory.glob('*' + self.suffix):
+            with open(path, encoding='utf-8') as f:
+                records.extend(BlockRecord(**json.loads(line)) for line in f)
+            path.unlink()
+
+        records.sort(key=lambda record: record.time, reverse=True)
+        return records
+
+    def write(self, top: int = 10) -> Path:
+        """
+        Writes the report of all the code blocks rendered, and logs a summary of the slowest ones.
+
+        Parameters
+        ----------
+        top
+            The number of the slowest code blocks to list in the summary.
+
+        Returns
+        -------
+        path
+            The path to the report.
+        """
+        records = self.collect()
+        path = self.directory / f'{self.name}.{self.format}'
+
+        if self.format == 'csv':
+            columns = [field.name for field in fields(BlockRecord)]
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, columns)
+                writer.writeheader()
+                writer.writerows(asdict(record) for record in records)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump([asdict(record) for record in records], f, indent=1)
+
+        total = sum(record.time for record in records)
+        fallbacks = sum(record.fallbacks for record in records)
+        LOGGER.info(f'sphinx-parsed-codeblock: rendered {len(records)} code blocks in '
+                    f'{total:.3f} s with {fallbacks} fallbacks; report written to {path}')
+
+        if records and top:
+            LOGGER.info(f'sphinx-parsed-codeblock: {min(top, len(records))} slowest code blocks:')
+            for record in records[:top]:
+                LOGGER.info(f'  {record.time * 1000:9.2f} ms  {record.document}:{record.line} '
+                            f'({record.lexer or "cached"}, {record.lines} lines, '
+                            f'{record.markup} markup, {record.fallbacks} fallbacks)')
+
+        return path
+
+
+class ReuseCounter:
+    """
+    Counts the code blocks that were not rendered because an identical code block had already been
+    rendered earlier in the build (see :confval:`parsed_codeblock_dedup`).
+
+    Like `BuildReport`, each process keeps its count in its own file, so that the code blocks
+    reused by the parallel write workers of ``sphinx-build -j N`` are counted too, and the counts
+    are summed by :py:meth:`collect` at the end of the build.
+
+    Parameters
+    ----------
+    directory
+        The directory in which to store the counts. Created if it does not exist.
+    """
+    suffix = '.count'
+
+    def __init__(self, directory: str | os.PathLike):
+        self.directory = Path(directory)
+        self._pid = os.getpid()
+        self._count = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.glob('*' + self.suffix):
+            path.unlink()
+
+    def add(self) -> None:
+        """Counts one more reused code block in the current process."""
+        pid = os.getpid()
+        if pid != self._pid:
+            # A write worker forked from the main process only counts its own code blocks
+            self._pid, self._count = pid, 0
+
+        self._count += 1
+        (self.directory / f'{pid}{self.suffix}').write_text(str(self._count), encoding='utf-8')
+
+    def collect(self) -> int:
+        """
+        Sums the counts of all the processes and removes them from the disk.
+
+        Returns
+        -------
+        count
+            The number of code blocks reused during the build.
+        """
+        count = 0
+        for path in self.directory.glob('*' + self.suffix):
+            count += int(path.read_text(encoding='utf-8'))
+            path.unlink()
+
+        return count
@@ -1,25 +1,70 @@
 from __future__ import annotations
 
-from copy import deepcopy
+from bisect import bisect_left, bisect_right
+import codecs
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import groupby
+import json
+import mmap
+import multiprocessing
+import os
+from pathlib import Path
 import re
-from typing import Generator, IO, TYPE_CHECKING
+from time import perf_counter
+from typing import Callable, Generator, Hashable, IO, Iterable, Sequence, TYPE_CHECKING
 
 from docutils import nodes
 from docutils.nodes import literal_block
+from docutils.parsers.rst import directives
+from docutils.statemachine import StringList
 
+import pygments
+from pygments.filters import ErrorToken
 from pygments.formatters.html import escape_html, HtmlFormatter
+from pygments.lexers.special import TextLexer
+from pygments.token import string_to_tokentype, Token
 
-from sphinx.directives.code import CodeBlock, container_wrapper
-from sphinx.util import logging
+from sphinx.addnodes import pending_xref
+from sphinx.builders.latex.nodes import captioned_literal_block
+from sphinx.config import ENUM
+from sphinx.directives.code import CodeBlock, container_wrapper, dedent_lines
+from sphinx.locale import __
+from sphinx.pycode import ModuleAnalyzer
+from sphinx.util import logging, parselinenos, texescape
+
+from .cache import DiskCache, LRUCache
+from .report import BlockRecord, BuildReport, CURRENT_RECORD, ReuseCounter, warn_fallback
 
 
 if TYPE_CHECKING:
+    from pygments.lexer import Lexer
+    from pygments.token import _TokenType
     from sphinx.builders.html import HTML5Translator
+    from sphinx.config import Config
+    from sphinx.environment import BuildEnvironment
+    from sphinx.highlighting import PygmentsBridge
+    from sphinx.writers.latex import LaTeXTranslator
     from sphinx.application import Sphinx
 
 
 LOGGER = logging.getLogger(__name__)
 
+CACHE_VERSION = 1
+"""Version of the rendered HTML, part of the cache keys - must be increased when the output changes."""
+
+LEXER_CACHE_SIZE = 256
+"""Maximum number of lexers, per language and options, kept for the duration of a build."""
+
+GUESSED_LEXER_CACHE_SIZE = 4096
+"""Maximum number of lexers guessed from the content of ``guess`` code blocks kept during a build."""
+
+MARKUP_WRAPPER_CACHE_SIZE = 4096
+"""Maximum number of rendered markup elements whose wrapping tags are memoized, see `split_markup`."""
+
+INCLUDE_CACHE_SIZE = 64
+"""Maximum number of selections of included files memoized, see `read_include`."""
+
 
 def split_parsed_codeblock(
     node: parsed_code_block
@@ -50,6 +95,131 @@ def split_parsed_codeblock(
             yield escape_html(child.astext()), child
 
 
+def markup_intervals(node: parsed_code_block) -> list[tuple[int, int, nodes.Node]]:
+    """
+    Finds the character intervals occupied by the markup elements of a parsed code block node.
+
+    The offsets are into the plain text of the node, i.e. ``node.astext()``, which is also the text
+    that is passed to the Pygments lexer.
+
+    Parameters
+    ----------
+    node
+        The `parsed_code_block` node that is being highlighted.
+
+    Returns
+    -------
+    intervals
+        The ``(start, end, markup)`` interval of each non-empty markup element, in order.
+    """
+    intervals = []
+    position = 0
+
+    for child in node.children:
+        end = position + len(child.astext())
+        if not isinstance(child, nodes.Text) and end > position:
+            intervals.append((position, end, child))
+        position = end
+
+    return intervals
+
+
+def markup_lines(source: str, intervals: list[tuple[int, int, nodes.Node]]) -> set[int]:
+    """
+    Finds the lines of a parsed code block that carry any markup.
+
+    Parameters
+    ----------
+    source
+        The plain text of the `parsed_code_block` node, i.e. ``node.astext()``.
+    intervals
+        The markup intervals of the node, as returned by :py:func:`markup_intervals`.
+
+    Returns
+    -------
+    lines
+        The (0-based) indices of all the lines that contain (a part of) a markup element.
+    """
+    lines = set()
+    line, position = 0, 0
+
+    for start, end, _ in intervals:
+        line += source.count('\n', position, start)
+        last = line + source.count('\n', start, end)
+        lines.update(range(line, last + 1))
+        line, position = last, end
+
+    return lines
+
+
+def align_markup(tokensource: Iterable[tuple[_TokenType, str]],
+                 source: str,
+                 intervals: list[tuple[int, int, nodes.Node]]
+                 ) -> Generator[tuple[_TokenType, str, int], None, None]:
+    """
+    Aligns the tokens produced by the lexer with the markup elements of a parsed code block.
+
+    This is the builder-neutral part of merging the markup with the syntax highlighting: the tokens
+    are split at the boundaries of the markup elements, so that each piece of text belongs to at
+    most one of them. How the markup is then applied to the pieces is up to the builder.
+
+    If the tokens do not match the source (e.g. because the lexer changed the text), a warning is
+    issued and the rest of the code block is yielded without any markup.
+
+    Parameters
+    ----------
+    tokensource
+        The ``(tokentype, value)`` tokens produced by the lexer.
+    source
+        The plain text of the `parsed_code_block` node, i.e. ``node.astext()``.
+    intervals
+        The markup intervals of the node, as returned by :py:func:`markup_intervals`.
+
+    Yields
+    ------
+    tokentype
+        The type of the token the piece of text comes from.
+    value
+        The piece of text.
+    markup
+        The index into ``intervals`` of the markup element containing the piece, or -1 if none.
+    """
+    n_markup = len(intervals)
+    m, shift, position = 0, None, 0
+    matched = True
+
+    for ttype, value in tokensource:
+        if shift is None and value:
+            # The lexer may have stripped leading whitespace from the source, and appended a newline
+            lead = len(source) - len(source.lstrip())
+            shift = source.find(value.rstrip('\n'), 0, lead + len(value))
+            matched, shift = shift >= 0, max(shift, 0)
+
+        # Skip the markup elements that have already ended, then check the token against the source
+        while m < n_markup and intervals[m][1] - shift <= position:
+            m += 1
+        tail = len(source) - position - shift
+        if m < n_markup and not (matched and source.startswith(value[:tail], position + shift)):
+            warn_fallback('Could not match the syntax highlighting to the source of a code-block; '
+                          'it will be stripped of sphinx markup (this is likely a bug)')
+            m = n_markup
+
+        start, end = position, position + len(value)
+        while position < end:
+            while m < n_markup and intervals[m][1] - shift <= position:
+                m += 1
+
+            if m == n_markup:
+                stop, index = end, -1
+            elif position < intervals[m][0] - shift:
+                stop, index = min(end, intervals[m][0] - shift), -1
+            else:
+                stop, index = min(end, intervals[m][1] - shift), m
+
+            yield ttype, value[position - start:stop - start], index
+            position = stop
+
+
 class PygmentsLineState:
     """
     Class for storing the current state of a Pygments line, used in :py:class:`MarkupHtmlFormatter`.
@@ -57,6 +227,11 @@ class PygmentsLineState:
     Given one line of text formatted by Pygments HTML formatter, this line is split into each
     individual ``<span></span>`` element - these can be iterated over to yield consecutive elements.
 
+    The line is scanned only once, on creation, and the boundaries of all the elements are stored
+    as integer offsets into the line (four per element: start of the opening tags, start of the
+    text, end of the text and end of the closing tags). Moving through the elements, cutting them
+    and restoring them is then done by slicing the original line at these offsets.
+
     Parameters
     ----------
     line
@@ -68,39 +243,90 @@ class PygmentsLineState:
         The opening `<span>` element and any other opening HTML tags.
     text
         The text contained in within the span tags.
+    html_close
+        The closing `</span>` element and any other closing HTML tags.
+
+    Raises
+    ------
+    StopIteration
+        If ``line`` does not contain any ``<span></span>`` elements.
     """
+    __slots__ = ('_line', '_offsets', '_index', '_start', '_end', 'html_span', 'text', 'html_close')
+
     def __init__(self, line: str):
-        self._span_iterator = re.finditer(r'(<span.*?>)(.*?)</span>', line)
-        self.html_span, self.text, self.html_close = self.__next__()
+        self._line = line
+        self._offsets = self._scan(line)
+        self._index = -4
+        self.next()
+
+    @staticmethod
+    def _scan(line: str) -> list[int]:
+        """
+        Scans ``line`` for ``<span></span>`` elements, returning the offsets of their parts.
+
+        Parameters
+        ----------
+        line
+            One line of text formatted by Pygments HTML formatter.
+
+        Returns
+        -------
+        offsets
+            Flat list containing, for each element, the offsets of the start of the opening tags,
+            the start of the text, the end of the text and the end of the closing tags.
+        """
+        offsets = []
+        base = 0
+
+        for piece in line.split('</span>')[:-1]:
+            span_start = piece.find('<span')
+            if span_start < 0:
+                break
+
+            text_start = piece.find('>', span_start) + 1
+            if text_start == 0:
+                break
+
+            # Any further opening tags directly inside the span are considered a part of it
+            while piece.startswith('<', text_start) and not piece.startswith('</', text_start):
+                text_start = piece.find('>', text_start) + 1 or len(piece)
+
+            text_end = piece.find('</', text_start)
+            if text_end < 0:
+                text_end = len(piece)
+
+            end = base + len(piece) + 7
+            offsets += (base + span_start, base + text_start, base + text_end, end)
+            base = end
+
+        return offsets
 
     def __iter__(self):
         return self
 
     def __next__(self) -> tuple[str, str, str]:
-        html_span, text = next(self._span_iterator).groups()
-        split = re.match(r'(.*?)(</.*>)', text)
-        if split is None:
-            text = text
-            html_close = r'</span>'
-        else:
-            text, html_close = split.groups()
-            html_close += r'</span>'
-
-        open = ''.join(re.findall(r'<.*?>', text))
-        text = text.replace(open, '')
-        html_span += open
-
-        return html_span, text, html_close
+        self.next()
+        return self.html_span, self.text, self.html_close
 
     def next(self) -> None:
         """Sets the state to the next element"""
-        self.html_span, self.text, self.html_close = self.__next__()
+        i = self._index + 4
+        if i >= len(self._offsets):
+            raise StopIteration
 
-    def iter(self) -> tuple[str, str, str]:
+        self._index = i
+        line, offsets = self._line, self._offsets
+        self._start = start = offsets[i]
+        self._end = end = offsets[i + 3]
+        text_start, text_end = offsets[i + 1], offsets[i + 2]
+
+        self.html_span = line[start:text_start]
+        self.text = line[text_start:text_end]
+        self.html_close = line[text_end:end]
+
+    def iter(self) -> Generator[tuple[str, str, str], None, None]:
         """Iterates over itself while saving the current state in the process."""
-        for s, t, c in self:
-            self.html_span, self.text, self.html_close = s, t, c
-            yield s, t, c
+        yield from self
 
     def __str__(self):
         return f'PygmentsLineState(html_span="{self.html_span}", text="{self.text}")'
@@ -115,8 +341,10 @@ class PygmentsLineState:
         n
             The number of characters to cut.
         """
+        text_end = self._offsets[self._index + 2]
+        self._start = min(self._start + len(self.html_span) + n, text_end)
         self.html_span = ''
-        self.text = self.text[n:]
+        self.text = self._line[self._start:text_end]
 
     def create_span(self, text: str) -> str:
         """
@@ -136,7 +364,11 @@ class PygmentsLineState:
 
     def restore_span(self) -> str:
         """Reconstructs the current span."""
-        return self.html_span + self.text + self.html_close
+        return self._line[self._start:self._end]
+
+
+class RenderBudgetExceeded(Exception):
+    """Raised by `MarkupHtmlFormatter` when rendering a code block takes longer than allowed."""
 
 
 class MarkupHtmlFormatter(HtmlFormatter):
@@ -153,17 +385,154 @@ class MarkupHtmlFormatter(HtmlFormatter):
         markup information.
     visitor
         The sphinx HTML formatter used for creating the sphinx HTML output.
+    engine
+        The engine used for merging the markup with the syntax highlighting. ``'tokens'`` merges
+        the markup with the tokens produced by the lexer, while ``'lines'`` merges it with the
+        lines of HTML already formatted by Pygments.
+    markup
+        The already rendered HTML source of each markup element of ``node`` (in the order given by
+        :py:func:`markup_intervals`). If not provided, each markup element is rendered using
+        ``visitor`` when it is needed.
+    deadline
+        The `time.perf_counter` value by which the formatting has to finish, otherwise
+        `RenderBudgetExceeded` is raised. No limit if ``None``.
     **options
         Pygments `pygments.formatters.html.HtmlFormatter` options.
     """
     def __init__(self,
                  node: parsed_code_block,
                  visitor: HTML5Translator,
+                 engine: str = 'tokens',
+                 markup: list[str] | None = None,
+                 deadline: float | None = None,
                  **options):
         super().__init__(**options)
 
-        self.sphinx_generator = split_parsed_codeblock(node)
+        self.node = node
         self.visitor = visitor
+        self.engine = engine
+        self.deadline = deadline
+        self.intervals = markup_intervals(node)
+
+        self.markup_sources = {}
+        if markup is not None:
+            self.markup_sources = {id(child): source
+                                   for (_, _, child), source in zip(self.intervals, markup)}
+
+        self.sphinx_items = []
+        self._item_lines = []
+        self._item = 0
+        self.sphinx_generator = self._iter_sphinx_items()
+        self.line_shift = 0
+
+    def _index_sphinx_items(self) -> list[tuple[int, str, nodes.Node | None]]:
+        """
+        Splits the node into lines and markup elements like :py:func:`split_parsed_codeblock`, but
+        also records the line on which each of them starts.
+
+        Returns
+        -------
+        items
+            The ``(line, text, markup)`` of each item, ``markup`` being ``None`` for plain text.
+        """
+        items = []
+        line = 0
+        for child in self.node.children:
+            text = child.astext()
+            if isinstance(child, nodes.Text):
+                for line, part in enumerate(text.split('\n'), line):
+                    items.append((line, escape_html(part), None))
+            else:
+                items.append((line, escape_html(text), child))
+                line += text.count('\n')
+
+        return items
+
+    def _iter_sphinx_items(self) -> Generator[tuple[str, nodes.Node | None], None, None]:
+        """Yields the ``(text, markup)`` of the items that have not been consumed yet."""
+        while self._item < len(self.sphinx_items):
+            _, text, markup = self.sphinx_items[self._item]
+            self._item += 1
+            yield text, markup
+
+    def _skip_line(self, line: int) -> None:
+        """Consumes all the remaining items that start on or before the given line."""
+        self._item = max(self._item, bisect_right(self._item_lines, line))
+
+    def _resync(self, line: int) -> None:
+        """
+        Consumes all the remaining items that start before the given line.
+
+        Normally, all of them have already been consumed by the previous lines. However, if
+        merging a line failed, the items have been consumed only up to the point of failure, and
+        the rest of them would throw all the following lines off.
+        """
+        self._item = max(self._item, bisect_left(self._item_lines, line))
+
+    def _find_line_shift(self,
+                         tokensource: Iterable[tuple[_TokenType, str]]
+                         ) -> Generator[tuple[_TokenType, str], None, None]:
+        """
+        Passes the tokens from the lexer through, finding the number of leading lines of the
+        source that the lexer stripped (see `line_shift`).
+
+        Parameters
+        ----------
+        tokensource
+            The ``(tokentype, value)`` tokens produced by the lexer.
+
+        Yields
+        ------
+        token
+            The tokens from ``tokensource``.
+        """
+        self.line_shift = None
+        for ttype, value in tokensource:
+            if self.line_shift is None and value:
+                source = self.node.astext()
+                lead = len(source) - len(source.lstrip())
+                shift = source.find(value.rstrip('\n'), 0, lead + len(value))
+                self.line_shift = source.count('\n', 0, shift) if shift >= 0 else -1
+            yield ttype, value
+
+    def _child_source(self, child: nodes.Node) -> str:
+        """
+        Gets the HTML source of a markup element, rendering it if it was not provided.
+
+        Parameters
+        ----------
+        child
+            A child of the `parsed_code_block` node. Should be a child that has a markup.
+
+        Returns
+        -------
+        source
+            The HTML source for the given `child`.
+        """
+        try:
+            return self.markup_sources[id(child)]
+        except KeyError:
+            return build_child_source(self.visitor, child)
+
+    def _markup_wrapper(self, child: nodes.Node, markup: str) -> tuple[str, str]:
+        """
+        Gets the HTML tags that sphinx wrapped around the text of a markup element.
+
+        Parameters
+        ----------
+        child
+            A child of the `parsed_code_block` node that has a markup.
+        markup
+            The HTML source of ``child``.
+
+        Returns
+        -------
+        start_tag
+            The start HTML tag applied by sphinx.
+        end_tag
+            The end HTML tag applied by sphinx.
+        """
+        return extract_markup_wrapper(markup, child.astext())
 
     def _insert_markup(self, tokensource: Generator) -> Generator[tuple[int, str], None, None]:
         """
@@ -181,8 +550,25 @@ class MarkupHtmlFormatter(HtmlFormatter):
         line: str
             The syntax-highlighted line containing sphinx markup.
         """
-        for t, line in tokensource:
-            yield t, ''.join(self._handle_one_line(line))
+        self.sphinx_items = self._index_sphinx_items()
+        self._item_lines = [line for line, _, _ in self.sphinx_items]
+        self._item = 0
+        lines = markup_lines(self.node.astext(), self.intervals)
+
+        for i, (t, line) in enumerate(tokensource):
+            if self.line_shift is None or self.line_shift < 0:
+                # The lines cannot be matched to the source; consume the items one after another
+                yield t, ''.join(self._handle_one_line(line))
+                continue
+
+            # The lines without markup are passed through without being taken apart
+            i += self.line_shift
+            if i not in lines:
+                self._skip_line(i)
+                yield t, line
+            else:
+                self._resync(i)
+                yield t, ''.join(self._handle_one_line(line))
 
     @staticmethod
     def _handle_text_line(sphinx_text: str,
@@ -218,35 +604,35 @@ class MarkupHtmlFormatter(HtmlFormatter):
         StopIteration
             If ``pygments_state`` has run out of elements, reaching the end of the line.
         """
-        while True:
-            if not sphinx_text:
-                break
-
-            if sphinx_text.startswith(pygments_state.text):
-                sphinx_text = sphinx_text[len(pygments_state.text):]
+        # The text is matched by moving a cursor through it rather than by slicing it, so that
+        # long lines with many spans take linear time
+        position, length = 0, len(sphinx_text)
+        while position < length:
+            text = pygments_state.text
+            if sphinx_text.startswith(text, position):
+                position += len(text)
                 new_line.append(pygments_state.restore_span())
                 try:
                     pygments_state.next()
                 except StopIteration:
-                    if sphinx_text:
-                        LOGGER.warning('sphinx-parsed-codeblock: '
-                                       'Could not resolve markup and syntax highlighting for a line'
-                                       ' (excess sphinx text); this line will be stripped of sphinx'
-                                       'markup (this is likely a bug)')
+                    if position < length:
+                        warn_fallback('Could not resolve markup and syntax highlighting for a line'
+                                      ' (excess sphinx text); this line will be stripped of sphinx'
+                                      'markup (this is likely a bug)')
                     raise
                 continue
 
             # Handles markup in the middle of a word
-            if pygments_state.text.startswith(sphinx_text):
-                new_line.append(pygments_state.html_span + sphinx_text)
-                pygments_state.cut(len(sphinx_text))
+            rest = sphinx_text[position:]
+            if text.startswith(rest):
+                new_line.append(pygments_state.html_span + rest)
+                pygments_state.cut(len(rest))
                 break
             else:
-                LOGGER.warning('sphinx-parsed-codeblock: '
-                               'Could not resolve markup and syntax highlighting (sphinx and '
-                               'pygments do not match); this line will be stripped of sphinx markup'
-                               'will probably cause much of the markup from a code-block '
-                               ' (this is likely a bug)')
+                warn_fallback('Could not resolve markup and syntax highlighting (sphinx and '
+                              'pygments do not match); this line will be stripped of sphinx markup'
+                              'will probably cause much of the markup from a code-block '
+                              ' (this is likely a bug)')
                 return None
         return new_line
 
@@ -281,23 +667,32 @@ class MarkupHtmlFormatter(HtmlFormatter):
             If everything went ok, ``None``, otherwise ``False``.
         """
         temp_line = [pygments_state.restore_span()]
-        matches = pygments_state.text
-        for _, text, _ in pygments_state.iter():
-            temp_line.append(pygments_state.restore_span())
-            matches += text
 
-            if matches == sphinx_text:
+        # The texts of the elements are matched against the sphinx text at a moving cursor rather
+        # than concatenated, so that long lines with many spans take linear time
+        position, length = len(pygments_state.text), len(sphinx_text)
+        matched = sphinx_text.startswith(pygments_state.text)
+        while matched and position < length:
+            try:
+                pygments_state.next()
+            except StopIteration:
+                matched = False
                 break
-        else:
-            LOGGER.warning('sphinx-parsed-codeblock: '
-                           'Could not resolve markup and syntax highlighting; one line of '
-                           'a code-block will be stripped of markup (this is likely a bug)')
+
+            text = pygments_state.text
+            matched = sphinx_text.startswith(text, position)
+            temp_line.append(pygments_state.restore_span())
+            position += len(text)
+
+        if not matched or position != length:
+            warn_fallback('Could not resolve markup and syntax highlighting; one line of '
+                          'a code-block will be stripped of markup (this is likely a bug)')
             return False
 
-        try:
-            start, end = sphinx_markup.split(''.join(matches))
-        except ValueError:
-            start, end = parse_complex_sphinx_source(sphinx_markup, matches)
+        wrapper = split_markup(sphinx_markup, sphinx_text)
+        if wrapper is None:
+            wrapper = parse_complex_sphinx_source(sphinx_markup, [sphinx_text])
+        start, end = wrapper
 
         new_line.append(start)
         new_line.extend(temp_line)
@@ -379,7 +774,7 @@ class MarkupHtmlFormatter(HtmlFormatter):
                     return line
                 continue
 
-            markup = build_child_source(self.visitor, markup)
+            markup = self._child_source(markup)
 
             result = self._handle_markup(sphinx_text, markup, pygments_state, new_line)
             if result is True:
@@ -393,9 +788,206 @@ class MarkupHtmlFormatter(HtmlFormatter):
                 new_line.append('\n')
                 return new_line
 
-    def format_unencoded(self, tokensource: Generator, outfile: IO) -> None:
-        source = self._format_lines(tokensource)
-        source = self._insert_markup(source)
+    def _get_span_opener(self, ttype: _TokenType) -> str:
+        """
+        Gets the opening ``<span>`` tag for a token type, the same way `HtmlFormatter` does.
+
+        Parameters
+        ----------
+        ttype
+            The Pygments token type.
+
+        Returns
+        -------
+        span
+            The opening ``<span>`` tag, or an empty string if the token type is not styled.
+        """
+        try:
+            return self.span_element_openers[ttype]
+        except KeyError:
+            pass
+
+        title = ' title="{}"'.format('.'.join(ttype)) if self.debug_token_types else ''
+        if self.noclasses:
+            css_style = self._get_css_inline_styles(ttype)
+            if css_style:
+                css_style = self.class2style[css_style][0]
+                cspan = f'<span style="{css_style}"{title}>'
+            else:
+                cspan = ''
+        else:
+            css_class = self._get_css_classes(ttype)
+            cspan = f'<span class="{css_class}"{title}>' if css_class else ''
+
+        self.span_element_openers[ttype] = cspan
+        return cspan
+
+    def _format_lines_with_markup(self,
+                                  tokensource: Iterable[tuple[_TokenType, str]]
+                                  ) -> Generator[tuple[int, str], None, None]:
+        """
+        Formats the tokens from the lexer into lines of HTML, inserting the sphinx markup.
+
+        This is the ``'tokens'`` engine, which replaces `HtmlFormatter._format_lines` entirely: the
+        character interval of every markup element is known beforehand (see
+        :py:func:`markup_intervals`), so the markup can be inserted while walking over the tokens
+        in a single pass. A markup element that lies within a single span is inserted inside it,
+        while a markup element that spans over multiple spans is wrapped around them (and closed
+        and reopened at the end of each line).
+
+        Parameters
+        ----------
+        tokensource
+            The ``(tokentype, value)`` tokens produced by the lexer.
+
+        Yields
+        ------
+        int
+            Always 1, as all the lines are a part of the source.
+        line: str
+            The syntax-highlighted line containing sphinx markup.
+        """
+        source = self.node.astext()
+        intervals = self.intervals
+        n_markup = len(intervals)
+        lsep = self.lineseparator
+
+        m = 0
+        shift = None
+        next_start = intervals[0][0] if intervals else -1
+        line, lspan = [], ''
+        outer_end, outer_close = -1, ''
+        position = 0
+
+        # Consecutive tokens with the same style end up in the same span, so they are merged first
+        runs = groupby(tokensource, key=lambda token: self._get_span_opener(token[0]))
+        for cspan, tokens in runs:
+            value = ''.join(token[1] for token in tokens)
+            if shift is None and value:
+                # The lexer may have stripped leading whitespace from the source, and appended a
+                # newline
+                lead = len(source) - len(source.lstrip())
+                shift = source.find(value.rstrip('\n'), 0, lead + len(value))
+                if shift < 0:
+                    warn_fallback('Could not match the syntax highlighting to the source of a '
+                                  'code-block; it will be stripped of sphinx markup (this is '
+                                  'likely a bug)')
+                    shift, n_markup = 0, 0
+                elif shift:
+                    intervals = [(s - shift, e - shift, c) for s, e, c in intervals]
+                    next_start = intervals[0][0] if intervals else -1
+
+            parts = value.split('\n')
+
+            for i, part in enumerate(parts):
+                if i:
+                    # End of line - close everything that is open and reopen it on the next line
+                    if lspan:
+                        line.append('</span>')
+                    line.append(outer_close)
+                    line.append(lsep)
+                    yield 1, ''.join(line)
+
+                    position += 1
+                    line, lspan = [], ''
+                    if outer_close:
+                        if outer_end > position:
+                            line.append(outer_start)
+                        else:
+                            outer_end, outer_close = -1, ''
+
+                start, end = position, position + len(part)
+                while position < end:
+                    if outer_close and outer_end <= position:
+                        if lspan:
+                            line.append('</span>')
+                            lspan = ''
+                        line.append(outer_close)
+                        outer_end, outer_close = -1, ''
+
+                    if m < n_markup and not outer_close and next_start <= position:
+                        markup_start, markup_end, child = intervals[m]
+                        m += 1
+                        next_start = intervals[m][0] if m < n_markup else -1
+                        markup = self._child_source(child)
+
+                        if markup_start >= start and markup_end <= end:
+                            text = part[markup_start - start:markup_end - start]
+                            if text != child.astext():
+                                warn_fallback('Could not resolve markup and syntax '
+                                              'highlighting (sphinx and pygments do not '
+                                              'match); the rest of the code-block will be '
+                                              'stripped of sphinx markup (this is likely a bug)')
+                                n_markup = 0
+                                continue
+
+                            if lspan != cspan:
+                                line.append((lspan and '</span>') + cspan)
+                                lspan = cspan
+                            line.append(markup)
+                            position = markup_end
+                        else:
+                            if lspan:
+                                line.append('</span>')
+                                lspan = ''
+                            outer_start, outer_close = self._markup_wrapper(child, markup)
+                            line.append(outer_start)
+                            outer_end = markup_end
+                        continue
+
+                    stop = end
+                    if outer_close:
+                        stop = min(stop, outer_end)
+                    elif m < n_markup:
+                        stop = min(stop, max(next_start, position + 1))
+
+                    if lspan != cspan:
+                        line.append((lspan and '</span>') + cspan)
+                        lspan = cspan
+                    line.append(escape_html(part[position - start:stop - start]))
+                    position = stop
+
+                if outer_close and outer_end <= position:
+                    if lspan:
+                        line.append('</span>')
+                        lspan = ''
+                    line.append(outer_close)
+                    outer_end, outer_close = -1, ''
+
+        if line:
+            if lspan:
+                line.append('</span>')
+            line.append(outer_close)
+            line.append(lsep)
+            yield 1, ''.join(line)
+
+    def _check_deadline(self,
+                        tokensource: Iterable[tuple[_TokenType, str]]
+                        ) -> Generator[tuple[_TokenType, str], None, None]:
+        """
+        Passes the tokens from the lexer through, raising `RenderBudgetExceeded` once the
+        `deadline` has passed.
+
+        The lexer produces the tokens lazily and the engines consume them as they go, so this
+        bounds the time spent both lexing and merging the markup.
+        """
+        deadline = self.deadline
+        for i, token in enumerate(tokensource):
+            if not i % 1024 and perf_counter() > deadline:
+                raise RenderBudgetExceeded
+            yield token
+
+    def format_unencoded(self, tokensource: Iterable[tuple[_TokenType, str]], outfile: IO) -> None:
+        if self.deadline is not None:
+            tokensource = self._check_deadline(tokensource)
+
+        if not self.intervals:
+            source = self._format_lines(tokensource)
+        elif self.engine == 'tokens':
+            source = self._format_lines_with_markup(tokensource)
+        else:
+            source = self._format_lines(self._find_line_shift(tokensource))
+            source = self._insert_markup(source)
 
         # As a special case, we wrap line numbers before line highlighting
         # so the line numbers get wrapped in the highlighting tag.
@@ -421,170 +1013,1974 @@ class MarkupHtmlFormatter(HtmlFormatter):
             outfile.write(piece)
 
 
-def parse_complex_sphinx_source(source: str, matches: list[str]) -> tuple[str, str]:
+class PlaceholderHtmlFormatter(MarkupHtmlFormatter):
     """
-    Attempts to parse sphinx-formatted HTML markup to find the HTML tags responsible.
+    Pygments HTML formatter that inserts placeholders in place of the sphinx markup.
 
-    Should be used when sphinx does not format a markup element by simply enclosing the text in some
-    HTML tags (e.g. ideally ``foo: **bar**`` -> ``foo: <b>bar</b>``), but instead inserts various
-    ``span`` elements inside, i.e. ``foo: **[1, 2]**`` ->
-    ``foo: <b><span>[1,</span><span> 2]</span></b>``. In the above example, this function attempts
-    to find and return the ``<b>`` and ``</b>`` tags.
+    This allows a `parsed_code_block` to be highlighted before its markup can be rendered, e.g. in
+    another process (see :py:func:`prerender_code_blocks`). The placeholders are replaced with the
+    HTML of the markup afterwards using :py:func:`fill_placeholders`. Only the ``'tokens'``
+    engine is supported.
 
     Parameters
     ----------
-    source
-        The sphinx-formatted HTML output, with the markup present in the HTML.
-    matches
-        The text that is expected inside the tags attempted to be found. Used for logging in case of
-        failure.
-
-    Returns
-    -------
-    start_tag
-        The start HTML tag applied by sphinx. Empty string if failed.
-    end_tag
-        The end HTML tag applied by sphinx. Empty string if failed.
+    node
+        The sphinx node being formatted.
+    visitor
+        Unused, accepted for compatibility with `MarkupHtmlFormatter`.
+    engine
+        Unused, accepted for compatibility with `MarkupHtmlFormatter`.
+    markup
+        Unused, accepted for compatibility with `MarkupHtmlFormatter`.
+    **options
+        Pygments `pygments.formatters.html.HtmlFormatter` options.
     """
-    try:
-        result = next(re.finditer(r'<span.*</span>', source))
-        return source[:result.start()], source[result.end():]
-    except StopIteration:
-        LOGGER.warning(f'sphinx-parsed-codeblock: '
-                       f'Sphinx HTML render of the "{"".join(matches)}" line could not be '
-                       f'interpreted; markup ignored.')
-        return '', ''
+    def __init__(self,
+                 node: parsed_code_block,
+                 visitor: HTML5Translator | None = None,
+                 engine: str = 'tokens',
+                 markup: list[str] | None = None,
+                 **options):
+        super().__init__(node, visitor, 'tokens', **options)
+        self.indices = {id(child): i for i, (_, _, child) in enumerate(self.intervals)}
 
+    def _child_source(self, child: nodes.Node) -> str:
+        return f'\x00{self.indices[id(child)]}\x01'
 
-class parsed_code_block(literal_block):
-    """Custom node for the parsed code-block - a subclass of `docutils.nodes.literal_block`"""
-    def protect_children(self):
-        """
-        Creates a deep copy of children in a new, otherwise unused variable.
+    def _markup_wrapper(self, child: nodes.Node, markup: str) -> tuple[str, str]:
+        i = self.indices[id(child)]
+        return f'\x00{i}\x02', f'\x00{i}\x03'
 
-        This is necessary for the children not to get deleted by sphinx/docutils when `parsed_code_block` is wrapped in
-        `docutils.nodes.container` when the ``caption`` is set.
 
-        The copy is not actually used, but its mere presence fixes the issue.
-        """
-        self._protected_children = deepcopy(self.children)
+PLACEHOLDER = re.compile('\x00([0-9]+)([\x01\x02\x03])')
 
 
-def build_child_source(visitor: HTML5Translator, child: nodes.Node) -> str:
+def fill_placeholders(highlighted: str, node: parsed_code_block, markup: list[str]) -> str:
     """
-    Formats a markup element using sphinx and returns the HTML code.
+    Replaces the placeholders inserted by `PlaceholderHtmlFormatter` with the HTML of the markup.
 
     Parameters
     ----------
-    visitor
-        The node visitor used for traversing nodes and creating HTML output.
-    child
-        A child of the `parsed_code_block` node. Should be a child that has a markup.
+    highlighted
+        The HTML produced by `PlaceholderHtmlFormatter`.
+    node
+        The `parsed_code_block` node that was highlighted.
+    markup
+        The HTML source of each markup element of ``node``, see :py:func:`render_markup`.
 
     Returns
     -------
-    source
-        The HTML source for the given `child`.
+    highlighted
+        The HTML with the markup inserted, same as produced by `MarkupHtmlFormatter`.
     """
-    i = len(visitor.body)
-    child.walkabout(visitor)
-    try:
-        source = visitor.body.pop(i)
-    except IndexError:
-        return ''
+    intervals = markup_intervals(node)
+    wrappers = {}
 
-    for j in range(i+1, len(visitor.body)+1):
-        source += visitor.body.pop(i)
+    def replace(match: re.Match) -> str:
+        i, kind = int(match[1]), match[2]
+        if kind == '\x01':
+            return markup[i]
 
-    return source
+        if i not in wrappers:
+            wrappers[i] = extract_markup_wrapper(markup[i], intervals[i][2].astext())
+        return wrappers[i][kind == '\x03']
 
+    return PLACEHOLDER.sub(replace, highlighted)
 
-def visit_parsed_code_block(self: HTML5Translator, node: parsed_code_block) -> None:
+
+HTML_TAG = re.compile(r'<[^>]*>')
+
+
+@lru_cache(maxsize=MARKUP_WRAPPER_CACHE_SIZE)
+def split_markup(markup: str, text: str, escaped: bool = True) -> tuple[str, str] | None:
     """
-    Visits the `parsed_code_block` node and creates the HTML output.
+    Splits the sphinx-formatted HTML of a markup element into the tags wrapped around its text.
+
+    The text is only searched for between the tags, so that it is not mistaken for e.g. the URL of
+    a link to that same URL. The same markup (e.g. a link to the same target) is usually rendered
+    many times, so the results are memoized, keeping the most recently used ones.
 
     Parameters
     ----------
-    self
-        The HTML translator.
-    node
-        The `parsed_code_block` node to create HTML output for
+    markup
+        The sphinx-formatted HTML output of a markup element.
+    text
+        The text of the markup element.
+    escaped
+        Whether ``text`` is already HTML-escaped.
+
+    Returns
+    -------
+    wrapper
+        The ``(start_tag, end_tag)`` applied by sphinx, or ``None`` if they could not be found.
     """
-    lang = node.get('language', 'default')
-    linenos = node.get('linenos', False)
-    highlight_args = node.get('highlight_args', {})
-    highlight_args['force'] = node.get('force', False)
-    opts = self.config.highlight_options.get(lang, {})
+    if not escaped:
+        text = escape_html(text)
+
+    if text:
+        found, position = -1, 0
+        for tag in [*HTML_TAG.finditer(markup), None]:
+            end = len(markup) if tag is None else tag.start()
+            index = markup.find(text, position, end)
+            if index != -1:
+                if found != -1 or markup.find(text, index + 1, end) != -1:
+                    found = -1
+                    break
+                found = index
+            position = end if tag is None else tag.end()
 
-    if linenos and self.config.html_codeblock_linenos_style:
-        linenos = self.config.html_codeblock_linenos_style
+        if found != -1:
+            return markup[:found], markup[found + len(text):]
 
-    og_formatter = self.highlighter.formatter
-    self.highlighter.formatter = MarkupHtmlFormatter
+    return _find_span_wrapper(markup)
 
-    highlight_args['node'] = node
-    highlight_args['visitor'] = self
 
-    highlighted = self.highlighter.highlight_block(
-        node.astext(),
-        lang,
-        opts=opts,
-        linenos=linenos,
-        location=node,
-        **highlight_args,
-    )
+def _find_span_wrapper(source: str) -> tuple[str, str] | None:
+    """Finds the tags around the ``span`` elements that sphinx inserted into the markup, if any."""
+    start = source.find('<span')
+    end = source.rfind('</span>')
+    if start == -1 or end < start:
+        return None
 
-    self.highlighter.formatter = og_formatter
+    return source[:start], source[end + len('</span>'):]
 
-    starttag = self.starttag(
-        node, 'div', suffix='', CLASS='highlight-%s notranslate' % lang
-    )
 
-    self.body.append(starttag + highlighted + '</div>\n')
-    raise nodes.SkipNode
+def extract_markup_wrapper(markup: str, text: str) -> tuple[str, str]:
+    """
+    Finds the HTML tags that sphinx wrapped around the text of a markup element.
 
+    Parameters
+    ----------
+    markup
+        The sphinx-formatted HTML output of a markup element.
+    text
+        The plain (not escaped) text of the markup element.
 
-def depart_parsed_code_block(self, node: parsed_code_block) -> None:
-    """Empty function; all HTML output for `parsed_code_block` occurs in `visit_parsed_code_block`"""
-    pass
+    Returns
+    -------
+    start_tag
+        The start HTML tag applied by sphinx. Empty string if failed.
+    end_tag
+        The end HTML tag applied by sphinx. Empty string if failed.
+    """
+    wrapper = split_markup(markup, text, False)
+    if wrapper is None:
+        return parse_complex_sphinx_source(markup, [text])
 
+    return wrapper
 
-class ParsedCodeBlock(CodeBlock):
-    def run(self) -> list[nodes.Node]:
-        text_nodes, messages = self.state.inline_text('\n'.join(self.content), self.lineno)
-        node = super().run()[0]
 
-        caption = self.options.get('caption')
-        if caption:
-            for child in node.children:
-                if not isinstance(child, nodes.caption):
-                    node = child
-                    break
-            else:
-                LOGGER.warning('sphinx-parsed-codeblock: '
-                               'parsed-code-block could not be created because of an issue '
-                               'with the caption; defaulting to the parsed-literal behaviour (this '
-                               'may be a bug)')
-                return [node]
+def parse_complex_sphinx_source(source: str, matches: list[str]) -> tuple[str, str]:
+    """
+    Attempts to parse sphinx-formatted HTML markup to find the HTML tags responsible.
+
+    Should be used when sphinx does not format a markup element by simply enclosing the text in some
+    HTML tags (e.g. ideally ``foo: **bar**`` -> ``foo: <b>bar</b>``), but instead inserts various
+    ``span`` elements inside, i.e. ``foo: **[1, 2]**`` ->
+    ``foo: <b><span>[1,</span><span> 2]</span></b>``. In the above example, this function attempts
+    to find and return the ``<b>`` and ``</b>`` tags.
+
+    Parameters
+    ----------
+    source
+        The sphinx-formatted HTML output, with the markup present in the HTML.
+    matches
+        The text that is expected inside the tags attempted to be found. Used for logging in case of
+        failure.
+
+    Returns
+    -------
+    start_tag
+        The start HTML tag applied by sphinx. Empty string if failed.
+    end_tag
+        The end HTML tag applied by sphinx. Empty string if failed.
+    """
+    wrapper = _find_span_wrapper(source)
+    if wrapper is None:
+        warn_fallback(f'Sphinx HTML render of the "{"".join(matches)}" line could not be '
+                      f'interpreted; markup ignored.')
+        return '', ''
+
+    return wrapper
+
+
+class parsed_code_block(literal_block):
+    """
+    Custom node for the parsed code-block - a subclass of `docutils.nodes.literal_block`
+
+    The node is pickled in a compact form: instead of all of its children, only its plain text
+    and the ``(start, end, payload)`` interval of each markup element are stored (where the payload
+    is either the markup node or, for simple text elements, just its class and attributes). The
+    children are then rebuilt from these when they are first accessed after unpickling.
+    """
+    @property
+    def children(self) -> list[nodes.Node]:
+        try:
+            return self.__dict__['children']
+        except KeyError:
+            pass
+
+        text, intervals = self.__dict__.pop('_compact')
+        self.__dict__['children'] = []
+
+        position = 0
+        for start, end, payload in intervals:
+            if start > position:
+                self.append(nodes.Text(text[position:start]))
+            self.append(self._unpack(payload, text[start:end]))
+            position = end
+
+        if position < len(text):
+            self.append(nodes.Text(text[position:]))
+
+        return self.__dict__['children']
+
+    @children.setter
+    def children(self, value: list[nodes.Node]) -> None:
+        self.__dict__['children'] = value
+        self.__dict__.pop('_compact', None)
+
+    def astext(self) -> str:
+        try:
+            return self.__dict__['_compact'][0]
+        except KeyError:
+            return super().astext()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if '_compact' in state:
+            return state
+
+        text, intervals = [], []
+        position = 0
+        for child in state.pop('children'):
+            child_text = child.astext()
+            end = position + len(child_text)
+            if not isinstance(child, nodes.Text):
+                intervals.append((position, end, self._pack(child)))
+
+            text.append(child_text)
+            position = end
+
+        state['_compact'] = (''.join(text), intervals)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+
+    @staticmethod
+    def _pack(child: nodes.Node) -> nodes.Node | tuple:
+        """Creates the pickled payload for a markup element, see :py:meth:`_unpack`."""
+        if (isinstance(child, nodes.TextElement) and len(child.children) == 1
+                and isinstance(child.children[0], nodes.Text)):
+            return type(child), child.rawsource, child.attributes, child.source, child.line
+        return child
+
+    @staticmethod
+    def _unpack(payload: nodes.Node | tuple, text: str) -> nodes.Node:
+        """Recreates a markup element from its payload (see :py:meth:`_pack`) and its text."""
+        if isinstance(payload, nodes.Node):
+            return payload
+
+        cls, rawsource, attributes, source, line = payload
+        child = cls(rawsource, text, **attributes)
+        child.source, child.line = source, line
+        return child
+
+
+def build_child_source(visitor: HTML5Translator, child: nodes.Node) -> str:
+    """
+    Formats a markup element using sphinx and returns the HTML code.
+
+    Parameters
+    ----------
+    visitor
+        The node visitor used for traversing nodes and creating HTML output.
+    child
+        A child of the `parsed_code_block` node. Should be a child that has a markup.
+
+    Returns
+    -------
+    source
+        The HTML source for the given `child`.
+    """
+    return build_children_source(visitor, [child])[0]
+
+
+def build_children_source(visitor: HTML5Translator, children: Sequence[nodes.Node]) -> list[str]:
+    """
+    Formats multiple markup elements using sphinx and returns the HTML code of each.
+
+    All the children are walked one after another, and their output is then captured from the end
+    of ``visitor.body`` and removed from it in one go.
+
+    Parameters
+    ----------
+    visitor
+        The node visitor used for traversing nodes and creating HTML output.
+    children
+        Children of the `parsed_code_block` node. Should be children that have a markup.
+
+    Returns
+    -------
+    sources
+        The HTML source for each of the `children`.
+    """
+    body = visitor.body
+    start = len(body)
+    ends = []
+    for child in children:
+        child.walkabout(visitor)
+        ends.append(len(body))
+
+    captured = body[start:]
+    del body[start:]
+
+    sources = []
+    previous = 0
+    for end in ends:
+        end -= start
+        sources.append(''.join(captured[previous:end]))
+        previous = end
+
+    return sources
+
+
+def markup_node_key(node: nodes.Node) -> Hashable:
+    """
+    Creates a key identifying a markup node by its structure.
+
+    Two nodes with the same key are rendered into the same HTML: the key consists of the class,
+    the attributes (e.g. the resolved ``refuri`` of a reference) and the children (including the
+    text) of the node.
+
+    Parameters
+    ----------
+    node
+        A child of the `parsed_code_block` node, or any of its descendants.
+
+    Returns
+    -------
+    key
+        The hashable key.
+    """
+    if isinstance(node, nodes.Text):
+        return str(node)
+
+    return (
+        type(node),
+        tuple((name, _freeze(value)) for name, value in sorted(node.attributes.items())),
+        tuple(markup_node_key(child) for child in node.children),
+    )
+
+
+def _freeze(value: object) -> Hashable:
+    """Converts lists and dicts in node attributes to tuples so that they can be hashed."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple((key, _freeze(item)) for key, item in sorted(value.items()))
+    return value
+
+
+def render_markup(visitor: HTML5Translator, node: parsed_code_block) -> list[str]:
+    """
+    Renders all the markup elements of a `parsed_code_block` into HTML.
+
+    If enabled (see :confval:`parsed_codeblock_markup_cache`), the HTML of each markup element is
+    memoized, so that identical markup elements (e.g. repeated links) are only rendered once.
+
+    Parameters
+    ----------
+    visitor
+        The HTML translator.
+    node
+        The `parsed_code_block` node whose markup to render.
+
+    Returns
+    -------
+    markup
+        The HTML source of each markup element, in the order given by :py:func:`markup_intervals`.
+    """
+    children = [child for _, _, child in markup_intervals(node)]
+    cache = getattr(visitor.builder, '_parsed_codeblock_markup_cache', None)
+    if cache is None:
+        return build_children_source(visitor, children)
+
+    # The document is a part of the key if the cache should not be shared between documents
+    scope = None
+    if visitor.config.parsed_codeblock_markup_cache == 'document':
+        scope = visitor.document.get('source')
+
+    keys = [(scope, markup_node_key(child)) for child in children]
+    markup = [cache.get(key) for key in keys]
+
+    missing = {}
+    for key, child, source in zip(keys, children, markup):
+        if source is None:
+            missing.setdefault(key, child)
+
+    rendered = dict(zip(missing, build_children_source(visitor, list(missing.values()))))
+    for key, source in rendered.items():
+        cache.set(key, source)
+
+    return [rendered[key] if source is None else source for key, source in zip(keys, markup)]
+
+
+def get_lexer(highlighter: PygmentsBridge,
+              source: str,
+              lang: str,
+              opts: dict | None = None,
+              force: bool = False,
+              location: nodes.Node | None = None,
+              lexers: LRUCache | None = None,
+              guessed_lexers: LRUCache | None = None) -> Lexer:
+    """
+    Gets the lexer for a code block, reusing a cached lexer if possible.
+
+    Lexers are cached in ``lexers`` by language and options, except for ``guess`` code blocks,
+    whose lexer depends on their content and is therefore cached in ``guessed_lexers`` by a hash of
+    the content. Languages that are not known to Pygments are not cached, so that the warning
+    about them is emitted for every code block, same as for the built-in code blocks.
+
+    Parameters
+    ----------
+    highlighter
+        The Sphinx highlighter, used for creating the lexers.
+    source
+        The text of the code block.
+    lang
+        The language of the code block.
+    opts
+        The options for the lexer.
+    force
+        Whether the lexer should not raise errors.
+    location
+        The location to report in warnings.
+    lexers
+        The cache of lexers, by language. If not provided, lexers are not cached.
+    guessed_lexers
+        The cache of guessed lexers, by content. If not provided, guessed lexers are not cached.
+
+    Returns
+    -------
+    lexer
+        The Pygments lexer.
+    """
+    if lang == 'guess':
+        cache = guessed_lexers
+        key = (DiskCache.make_key(source), _freeze(opts), force)
+    else:
+        cache = lexers
+        # Sphinx picks the lexer of Python code blocks based on whether they start with a prompt
+        key = (lang, source.startswith('>>>'), _freeze(opts), force)
+
+    if cache is None:
+        return highlighter.get_lexer(source, lang, opts, force, location)
+
+    lexer = cache.get(key)
+    if lexer is None:
+        lexer = highlighter.get_lexer(source, lang, opts, force, location)
+        if lang == 'guess' or type(lexer) is not TextLexer:
+            cache.set(key, lexer)
+
+    return lexer
+
+
+def dump_tokens(tokens: Iterable[tuple[_TokenType, str]]) -> str:
+    """
+    Serializes the tokens produced by a lexer into a compact string, see `load_tokens`.
+
+    Parameters
+    ----------
+    tokens
+        The ``(tokentype, value)`` tokens.
+
+    Returns
+    -------
+    data
+        The tokens as JSON, with each token type stored only once.
+    """
+    types = {}
+    data = [(types.setdefault(ttype, len(types)), value) for ttype, value in tokens]
+    return json.dumps(['.'.join(ttype) for ttype in types] + [data], separators=(',', ':'))
+
+
+def load_tokens(data: str) -> list[tuple[_TokenType, str]]:
+    """
+    Deserializes the tokens serialized by `dump_tokens`.
+
+    Parameters
+    ----------
+    data
+        The serialized tokens.
+
+    Returns
+    -------
+    tokens
+        The ``(tokentype, value)`` tokens.
+    """
+    *types, data = json.loads(data)
+    types = [string_to_tokentype(ttype) for ttype in types]
+    return [(types[i], value) for i, value in data]
+
+
+def get_tokens(lexer: Lexer,
+               source: str,
+               lang: str,
+               opts: dict | None = None,
+               force: bool = False,
+               token_cache: DiskCache | None = None) -> Iterable[tuple[_TokenType, str]]:
+    """
+    Lexes the source of a code block, reusing the tokens from the on-disk cache if possible (see
+    :confval:`parsed_codeblock_token_cache`).
+
+    The tokens do not depend on the builder or on the markup, so they can be reused by all the
+    builders run on the same doctree directory, and only the formatting has to be done again.
+
+    Parameters
+    ----------
+    lexer
+        The lexer for the code block, see `get_lexer`.
+    source
+        The text of the code block.
+    lang
+        The language of the code block.
+    opts
+        The options for the lexer.
+    force
+        Whether the lexer does not raise errors.
+    token_cache
+        The on-disk cache of tokens. If not provided, the source is simply lexed.
+
+    Returns
+    -------
+    tokens
+        The ``(tokentype, value)`` tokens.
+
+    Raises
+    ------
+    ErrorToken
+        If the lexer produces an error and ``force`` is not set. Nothing is cached in that case.
+    """
+    if token_cache is None:
+        return lexer.get_tokens(source)
+
+    key = DiskCache.make_key(CACHE_VERSION, pygments.__version__, source, lang, _freeze(opts),
+                             force)
+    data = token_cache.get(key)
+    if data is not None:
+        return load_tokens(data)
+
+    tokens = list(lexer.get_tokens(source))
+    token_cache.set(key, dump_tokens(tokens))
+    return tokens
+
+
+class BodyWriter:
+    """
+    File-like object that writes the output of the Pygments formatter directly into the body of the
+    HTML translator, in chunks.
+
+    Used for streaming very large code blocks (see :confval:`parsed_codeblock_stream_threshold`),
+    so that their HTML is never held in memory more than once, as it would be if it were first
+    written into a `io.StringIO` and then appended to the body as one string.
+
+    Parameters
+    ----------
+    body
+        The body of the HTML translator.
+    chunk_size
+        The number of pieces (i.e. lines, as written by the formatter) to join into a single item
+        of ``body``.
+    """
+    def __init__(self, body: list[str], chunk_size: int = 1000):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.start = len(body)
+        self._buffer = []
+
+    def write(self, piece: str) -> None:
+        self._buffer.append(piece)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Appends the buffered pieces to the body."""
+        if self._buffer:
+            self.body.append(''.join(self._buffer))
+            self._buffer = []
+
+    def discard(self) -> None:
+        """Removes everything written so far from the body, e.g. to start over after an error."""
+        del self.body[self.start:]
+        self._buffer = []
+
+
+def relax_lexing(lang: str,
+                 force: bool,
+                 error: ErrorToken,
+                 location: nodes.Node | None = None) -> tuple[str, bool]:
+    """
+    Relaxes the lexing of a code block after the lexer produced an error, the same way Sphinx does.
+
+    Parameters
+    ----------
+    lang
+        The language of the code block.
+    force
+        Whether the code was already being highlighted even if the lexer produces errors.
+    error
+        The error produced by the lexer.
+    location
+        The location to report in warnings.
+
+    Returns
+    -------
+    lang
+        The language to retry with.
+    force
+        Whether to retry even if the lexer produces errors.
+    """
+    # Most probably not the selected language, so retry in relaxed mode
+    if lang == 'default':
+        return 'none', force
+
+    LOGGER.warning(f'sphinx-parsed-codeblock: Lexing parsed code block as "{lang}" resulted '
+                   f'in an error at token: {str(error)!r}. Retrying in relaxed mode.',
+                   type='misc', subtype='highlighting_failure', location=location)
+    if force:
+        return 'none', force
+    return lang, True
+
+
+def highlight_parsed_block(highlighter: PygmentsBridge,
+                           node: parsed_code_block,
+                           visitor: HTML5Translator,
+                           source: str,
+                           lang: str,
+                           opts: dict | None = None,
+                           force: bool = False,
+                           location: nodes.Node | None = None,
+                           engine: str = 'tokens',
+                           markup: list[str] | None = None,
+                           lexers: LRUCache | None = None,
+                           guessed_lexers: LRUCache | None = None,
+                           token_cache: DiskCache | None = None,
+                           formatter_class: type[MarkupHtmlFormatter] = MarkupHtmlFormatter,
+                           outfile: BodyWriter | None = None,
+                           **kwargs) -> str | None:
+    """
+    Highlights the source of a `parsed_code_block` node, merging in its markup.
+
+    Equivalent to `sphinx.highlighting.PygmentsBridge.highlight_block`, except that the
+    `MarkupHtmlFormatter` is created for this call only, so that neither ``highlighter`` nor the
+    node are modified. Multiple blocks can therefore be highlighted concurrently, and an exception
+    cannot leave ``highlighter`` in a broken state.
+
+    Parameters
+    ----------
+    highlighter
+        The Sphinx highlighter of the HTML translator, used for its lexers and formatter options.
+    node
+        The `parsed_code_block` node being highlighted.
+    visitor
+        The sphinx HTML translator, used for rendering the markup that is not in ``markup``.
+    source
+        The text of ``node``.
+    lang
+        The language of the code block.
+    opts
+        The options for the lexer.
+    force
+        Whether to highlight the code even if the lexer produces errors.
+    location
+        The location to report in warnings.
+    engine
+        The engine used for merging the markup with the highlighting, see `MarkupHtmlFormatter`.
+    markup
+        The already rendered HTML source of each markup element of ``node``.
+    lexers
+        The cache of lexers by language, see `get_lexer`.
+    guessed_lexers
+        The cache of lexers guessed from the content of code blocks, see `get_lexer`.
+    token_cache
+        The on-disk cache of tokens, see `get_tokens`.
+    formatter_class
+        The formatter to use.
+    outfile
+        If provided, the HTML is streamed into it instead of being returned.
+    **kwargs
+        Further options for the formatter, e.g. ``linenos`` or ``hl_lines``.
+
+    Returns
+    -------
+    highlighted
+        The HTML of the highlighted code block, or ``None`` if ``outfile`` is provided.
+    """
+    lexer = get_lexer(highlighter, source, lang, opts, force, location, lexers, guessed_lexers)
+    record = CURRENT_RECORD.get()
+    if record is not None:
+        record.lexer = lexer.name
+
+    kwargs.update(highlighter.formatter_args)
+    formatter = formatter_class(node, visitor, engine=engine, markup=markup, **kwargs)
+    try:
+        tokens = get_tokens(lexer, source, lang, opts, force, token_cache)
+        return pygments.format(tokens, formatter, outfile)
+    except ErrorToken as err:
+        if outfile is not None:
+            outfile.discard()
+        lang, force = relax_lexing(lang, force, err, location)
+
+    lexer = get_lexer(highlighter, source, lang, opts, force, location, lexers, guessed_lexers)
+    return pygments.format(get_tokens(lexer, source, lang, opts, force, token_cache), formatter,
+                           outfile)
+
+
+def render_parsed_code_block(self: HTML5Translator,
+                             node: parsed_code_block,
+                             lang: str,
+                             linenos: bool | str,
+                             opts: dict,
+                             outfile: BodyWriter | None = None) -> str | None:
+    """
+    Renders the markup of a `parsed_code_block` node and merges it with the syntax highlighting,
+    reusing the HTML of an identical code block rendered earlier in the build or from the on-disk
+    cache if possible.
+
+    If ``outfile`` is provided, the HTML is streamed into it instead, and no caches are used, since
+    they would need the whole HTML in memory.
+
+    If a report is being made, the statistics of the code block are stored in `CURRENT_RECORD`.
+
+    Parameters
+    ----------
+    self
+        The HTML translator.
+    node
+        The `parsed_code_block` node to render.
+    lang
+        The language of the code block.
+    linenos
+        Whether (and how) to show line numbers.
+    opts
+        The options for the lexer.
+    outfile
+        The writer to stream the HTML into, if any.
+
+    Returns
+    -------
+    highlighted
+        The HTML of the highlighted code block, or ``None`` if ``outfile`` is provided.
+    """
+    highlight_args = node.get('highlight_args', {})
+    force = node.get('force', False)
+    source = node.astext()
+    engine = self.config.parsed_codeblock_engine
+
+    start = perf_counter()
+    markup = render_markup(self, node)
+    markup_time = perf_counter() - start
+
+    cache = getattr(self.builder, '_parsed_codeblock_cache', None)
+    rendered = getattr(self.builder, '_parsed_codeblock_rendered', None)
+    prerendered = getattr(self.builder, '_parsed_codeblock_prerendered', None)
+    if outfile is not None:
+        cache, rendered, prerendered = None, None, None
+
+    highlighted = None
+    if cache is not None or rendered is not None:
+        style = self.highlighter.formatter_args.get('style')
+        key = DiskCache.make_key(CACHE_VERSION, source, lang, sorted(opts.items()), linenos, force,
+                                 sorted(highlight_args.items()), engine,
+                                 getattr(style, '__name__', style), pygments.__version__, markup)
+
+        # An identical code block may have already been rendered in this build
+        if rendered is not None:
+            highlighted = rendered.get(key)
+            if highlighted is not None:
+                self.builder._parsed_codeblock_reused.add()
+        if highlighted is None and cache is not None:
+            highlighted = cache.get(key)
+
+    cached = highlighted is not None
+    result = None
+    if not cached and prerendered and engine == 'tokens':
+        result = prerendered.get(prerender_key(node, lang, linenos, opts))
+        if result is not None:
+            highlighted, lexer, _, fallbacks = result
+            highlighted = fill_placeholders(highlighted, node, markup)
+
+            record = CURRENT_RECORD.get()
+            if record is not None:
+                record.lexer = lexer
+                record.fallbacks += fallbacks
+
+            if cache is not None:
+                cache.set(key, highlighted)
+
+    if not cached and result is None:
+        budget = self.config.parsed_codeblock_time_budget
+        try:
+            highlighted = highlight_parsed_block(
+                self.highlighter,
+                node,
+                self,
+                source,
+                lang,
+                opts=opts,
+                force=force,
+                location=node,
+                engine=engine,
+                markup=markup,
+                lexers=getattr(self.builder, '_parsed_codeblock_lexer_cache', None),
+                guessed_lexers=getattr(self.builder, '_parsed_codeblock_guessed_lexer_cache', None),
+                # Caching would need all the tokens of a streamed block in memory at once
+                token_cache=None if outfile is not None else getattr(
+                    self.builder, '_parsed_codeblock_token_cache', None
+                ),
+                outfile=outfile,
+                deadline=None if budget is None else start + budget,
+                linenos=linenos,
+                **highlight_args,
+            )
+        except RenderBudgetExceeded:
+            fallback = self.config.parsed_codeblock_budget_fallback
+            LOGGER.warning(f'sphinx-parsed-codeblock: rendering the code block took longer than '
+                           f'{budget} s; it is rendered without '
+                           f'{"markup" if fallback == "highlight" else "syntax highlighting"} '
+                           f'instead', location=node)
+            record = CURRENT_RECORD.get()
+            if record is not None:
+                record.fallbacks += 1
+
+            highlighted = render_budget_fallback(self, node, lang, linenos, opts, markup, fallback)
+            if outfile is not None:
+                outfile.discard()
+                outfile.write(highlighted)
+                highlighted = None
+            # Not worth keeping across builds, which may be faster, nor reusing for identical
+            # code blocks, which would then silently lose their markup or highlighting too
+            cache, rendered = None, None
+
+        if cache is not None:
+            cache.set(key, highlighted)
+
+    if rendered is not None:
+        rendered.set(key, highlighted)
+
+    record = CURRENT_RECORD.get()
+    if record is not None:
+        record.lines = source.count('\n') + 1
+        record.markup = len(markup)
+        record.markup_time = markup_time
+        record.merge_time = perf_counter() - start - markup_time
+        record.cached = cached
+        if result is not None:
+            # Also count the time spent highlighting the code block in advance
+            record.merge_time += result[2]
+
+    return highlighted
+
+
+def render_budget_fallback(self: HTML5Translator,
+                           node: parsed_code_block,
+                           lang: str,
+                           linenos: bool | str,
+                           opts: dict,
+                           markup: list[str],
+                           fallback: str = 'highlight') -> str:
+    """
+    Renders a `parsed_code_block` node that could not be rendered within the time budget (see
+    :confval:`parsed_codeblock_time_budget`).
+
+    Parameters
+    ----------
+    self
+        The HTML translator.
+    node
+        The `parsed_code_block` node to render.
+    lang
+        The language of the code block.
+    linenos
+        Whether (and how) to show line numbers.
+    opts
+        The options for the lexer.
+    markup
+        The HTML source of each markup element of ``node``, see :py:func:`render_markup`.
+    fallback
+        Either ``'highlight'``, to highlight the code block as a plain ``code-block`` without the
+        markup, or ``'literal'``, to keep the markup without any syntax highlighting, as a
+        ``parsed-literal`` would.
+
+    Returns
+    -------
+    highlighted
+        The HTML of the code block.
+    """
+    if fallback == 'highlight':
+        return self.highlighter.highlight_block(node.astext(), lang, opts=opts,
+                                                force=node.get('force', False), location=node,
+                                                linenos=linenos, **node.get('highlight_args', {}))
+
+    # Highlighted as plain text, which is a single token, so merging the markup is cheap while the
+    # line numbers and emphasized lines are kept (the lines engine needs every token in a span)
+    return highlight_parsed_block(self.highlighter, node, self, node.astext(), 'none', force=True,
+                                  location=node, engine='tokens', markup=markup,
+                                  linenos=linenos, **node.get('highlight_args', {}))
+
+
+def highlight_settings(config: Config, node: parsed_code_block) -> tuple[str, bool | str, dict]:
+    """
+    Gets the settings with which a `parsed_code_block` node is highlighted.
+
+    Parameters
+    ----------
+    config
+        The Sphinx configuration.
+    node
+        The `parsed_code_block` node.
+
+    Returns
+    -------
+    lang
+        The language of the code block.
+    linenos
+        Whether (and how) to show line numbers.
+    opts
+        The options for the lexer.
+    """
+    lang = node.get('language', 'default')
+    linenos = node.get('linenos', False)
+    opts = config.highlight_options.get(lang, {})
 
-        custom_node = parsed_code_block('', '')
-        custom_node.__dict__ = node.__dict__
-        custom_node.children = []
-        custom_node.extend(text_nodes)
+    if linenos and config.html_codeblock_linenos_style:
+        linenos = config.html_codeblock_linenos_style
 
+    return lang, linenos, opts
+
+
+def visit_parsed_code_block(self: HTML5Translator, node: parsed_code_block) -> None:
+    """
+    Visits the `parsed_code_block` node and creates the HTML output.
+
+    Parameters
+    ----------
+    self
+        The HTML translator.
+    node
+        The `parsed_code_block` node to create HTML output for
+    """
+    lang, linenos, opts = highlight_settings(self.config, node)
+    starttag = self.starttag(
+        node, 'div', suffix='', CLASS='highlight-%s notranslate' % lang
+    )
+
+    # Very large code blocks are streamed into the body, counting the lines without astext()
+    outfile = None
+    threshold = self.config.parsed_codeblock_stream_threshold
+    if threshold and sum(child.astext().count('\n') for child in node.children) + 1 >= threshold:
+        self.body.append(starttag)
+        outfile = BodyWriter(self.body, self.config.parsed_codeblock_stream_chunk_size)
+
+    report = getattr(self.builder, '_parsed_codeblock_report', None)
+    if report is None:
+        highlighted = render_parsed_code_block(self, node, lang, linenos, opts, outfile)
+    else:
+        document = getattr(self.builder, 'current_docname', None) or node.source
+        record = BlockRecord(document, node.line)
+        token = CURRENT_RECORD.set(record)
+        try:
+            highlighted = render_parsed_code_block(self, node, lang, linenos, opts, outfile)
+        finally:
+            CURRENT_RECORD.reset(token)
+        report.add(record)
+
+    if outfile is None:
+        self.body.append(starttag + highlighted + '</div>\n')
+    else:
+        outfile.flush()
+        self.body.append('</div>\n')
+    raise nodes.SkipNode
+
+
+def depart_parsed_code_block(self, node: parsed_code_block) -> None:
+    """Empty function; all HTML output for `parsed_code_block` occurs in `visit_parsed_code_block`"""
+    pass
+
+
+LATEX_PLACEHOLDER = re.compile('\ue000([0-9]+)([\ue001\ue002])')
+
+
+def latex_markup_tokens(aligned: Iterable[tuple[_TokenType, str, int]]
+                        ) -> Generator[tuple[_TokenType, str], None, None]:
+    """
+    Turns the tokens aligned with the markup (see :py:func:`align_markup`) back into tokens for the
+    Pygments LaTeX formatter, with placeholders where each markup element starts and ends.
+
+    A LaTeX group cannot span multiple lines of a ``Verbatim`` environment, so the markup is closed
+    at the end of each line and opened again on the next one. The placeholders are plain text,
+    which the formatter outputs as-is, and are replaced by the LaTeX of the markup afterwards.
+
+    Parameters
+    ----------
+    aligned
+        The ``(tokentype, value, markup)`` pieces from :py:func:`align_markup`.
+
+    Yields
+    ------
+    tokentype
+        The type of the token.
+    value
+        The text of the token.
+    """
+    current = -1
+    for ttype, value, m in aligned:
+        if m != current:
+            if current >= 0:
+                yield Token.Text, f'\ue000{current}\ue002'
+            if m >= 0:
+                yield Token.Text, f'\ue000{m}\ue001'
+            current = m
+
+        if current < 0 or '\n' not in value:
+            yield ttype, value
+            continue
+
+        for i, line in enumerate(value.split('\n')):
+            if i:
+                yield Token.Text, f'\ue000{current}\ue002'
+                yield ttype, '\n'
+                yield Token.Text, f'\ue000{current}\ue001'
+            if line:
+                yield ttype, line
+
+    if current >= 0:
+        yield Token.Text, f'\ue000{current}\ue002'
+
+
+def highlight_parsed_block_latex(highlighter: PygmentsBridge,
+                                 node: parsed_code_block,
+                                 source: str,
+                                 lang: str,
+                                 wrappers: list[tuple[str, str]],
+                                 opts: dict | None = None,
+                                 force: bool = False,
+                                 location: nodes.Node | None = None,
+                                 lexers: LRUCache | None = None,
+                                 guessed_lexers: LRUCache | None = None,
+                                 token_cache: DiskCache | None = None,
+                                 **kwargs) -> str:
+    """
+    Highlights the source of a `parsed_code_block` node into LaTeX, merging in its markup.
+
+    Equivalent to `sphinx.highlighting.PygmentsBridge.highlight_block` for LaTeX.
+
+    Parameters
+    ----------
+    highlighter
+        The Sphinx highlighter of the LaTeX translator.
+    node
+        The `parsed_code_block` node being highlighted.
+    source
+        The text of ``node``.
+    lang
+        The language of the code block.
+    wrappers
+        The LaTeX ``(start, end)`` of each markup element of ``node`` (in the order given by
+        :py:func:`markup_intervals`), to be wrapped around its highlighted text.
+    opts
+        The options for the lexer.
+    force
+        Whether to highlight the code even if the lexer produces errors.
+    location
+        The location to report in warnings.
+    lexers
+        The cache of lexers by language, see `get_lexer`.
+    guessed_lexers
+        The cache of lexers guessed from the content of code blocks, see `get_lexer`.
+    token_cache
+        The on-disk cache of tokens, see `get_tokens`.
+    **kwargs
+        Further options for the formatter, e.g. ``linenos``.
+
+    Returns
+    -------
+    highlighted
+        The LaTeX of the highlighted code block.
+    """
+    # Text that would be mistaken for placeholders cannot carry markup
+    intervals = markup_intervals(node) if '\ue000' not in source else []
+    formatter = highlighter.get_formatter(**kwargs)
+
+    def highlight(lang: str, force: bool) -> str:
+        lexer = get_lexer(highlighter, source, lang, opts, force, location, lexers, guessed_lexers)
+        tokens = get_tokens(lexer, source, lang, opts, force, token_cache)
+        tokens = align_markup(tokens, source, intervals)
+        return pygments.format(latex_markup_tokens(tokens), formatter)
+
+    try:
+        highlighted = highlight(lang, force)
+    except ErrorToken as err:
+        highlighted = highlight(*relax_lexing(lang, force, err, location))
+
+    highlighted = texescape.hlescape(highlighted, highlighter.latex_engine)
+    return LATEX_PLACEHOLDER.sub(lambda match: wrappers[int(match[1])][match[2] == '\ue002'],
+                                 highlighted)
+
+
+LATEX_ESCAPE = re.compile(r'\\.', re.DOTALL)
+
+
+def _balanced(latex: str) -> bool:
+    """Whether the unescaped braces in a piece of LaTeX are balanced."""
+    depth = 0
+    for char in LATEX_ESCAPE.sub('', latex):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth < 0:
+                return False
+
+    return depth == 0
+
+
+@lru_cache(maxsize=MARKUP_WRAPPER_CACHE_SIZE)
+def split_latex_markup(markup: str, text: str) -> tuple[str, str] | None:
+    """
+    Splits the sphinx-formatted LaTeX of a markup element into the commands wrapped around its text.
+
+    Unlike in HTML, the text of a markup element often also appears elsewhere in its LaTeX (e.g. in
+    the name of a command or in the URL of a link), so it cannot simply be searched for. Instead,
+    the text is expected to be the innermost argument of the last command, i.e. to be followed only
+    by closing braces, with the rest of the LaTeX being balanced around it.
+
+    Parameters
+    ----------
+    markup
+        The sphinx-formatted LaTeX output of a markup element.
+    text
+        The text of the markup element, encoded for LaTeX.
+
+    Returns
+    -------
+    wrapper
+        The ``(start, end)`` LaTeX around the text, or ``None`` if they could not be found.
+    """
+    if not text:
+        return None
+
+    n_braces = len(markup) - len(markup.rstrip('}'))
+    for i in range(n_braces + 1):
+        end = len(markup) - i
+        if not markup.endswith(text, 0, end):
+            continue
+
+        start, end = markup[:end - len(text)], markup[end:]
+        if _balanced(start + end):
+            return start, end
+
+    return None
+
+
+def visit_parsed_code_block_latex(self: LaTeXTranslator, node: parsed_code_block) -> None:
+    """
+    Visits the `parsed_code_block` node and creates the LaTeX output, the same way as Sphinx does
+    for a ``code-block``.
+
+    Parameters
+    ----------
+    self
+        The LaTeX translator.
+    node
+        The `parsed_code_block` node to create LaTeX output for
+    """
+    labels = self.hypertarget_to(node)
+    if isinstance(node.parent, captioned_literal_block):
+        labels += self.hypertarget_to(node.parent)
+    if labels and not self.in_footnote:
+        self.body.append('\n' + r'\def\sphinxLiteralBlockLabel{' + labels + '}')
+
+    lang = node.get('language', 'default')
+    linenos = node.get('linenos', False)
+    highlight_args = node.get('highlight_args', {})
+    opts = self.config.highlight_options.get(lang, {})
+
+    # The markup ends up inside a verbatim environment, same as in a parsed-literal
+    self.in_parsed_literal += 1
+    try:
+        markup = render_markup(self, node)
+    finally:
+        self.in_parsed_literal -= 1
+
+    wrappers = []
+    for (_, _, child), source in zip(markup_intervals(node), markup):
+        wrapper = split_latex_markup(source, self.encode(child.astext()))
+        # Each line is wrapped separately (see latex_markup_tokens), so the wrapper must not
+        # span lines itself
+        if wrapper is None or '\n' in ''.join(wrapper):
+            warn_fallback(f'LaTeX render of "{child.astext()}" could not be interpreted; markup '
+                          f'ignored.')
+            wrapper = '', ''
+        wrappers.append(wrapper)
+
+    hlcode = highlight_parsed_block_latex(
+        self.highlighter,
+        node,
+        node.astext(),
+        lang,
+        wrappers,
+        opts=opts,
+        force=node.get('force', False),
+        location=node,
+        lexers=getattr(self.builder, '_parsed_codeblock_lexer_cache', None),
+        guessed_lexers=getattr(self.builder, '_parsed_codeblock_guessed_lexer_cache', None),
+        token_cache=getattr(self.builder, '_parsed_codeblock_token_cache', None),
+        linenos=linenos,
+        **highlight_args,
+    )
+
+    # The rest is the same as for a code-block
+    if self.in_footnote:
+        self.body.append('\n' + r'\sphinxSetupCodeBlockInFootnote')
+        hlcode = hlcode.replace(r'\begin{Verbatim}', r'\begin{sphinxVerbatim}')
+    elif self.table:
+        self.table.has_problematic = True
+        self.table.has_verbatim = True
+        hlcode = hlcode.replace(r'\begin{Verbatim}', r'\begin{sphinxVerbatimintable}')
+    else:
+        hlcode = hlcode.replace(r'\begin{Verbatim}', r'\begin{sphinxVerbatim}')
+
+    hlcode = hlcode.rstrip()[:-14]  # strip \end{Verbatim}
+    if self.table and not self.in_footnote:
+        hlcode += r'\end{sphinxVerbatimintable}'
+    else:
+        hlcode += r'\end{sphinxVerbatim}'
+
+    hllines = str(highlight_args.get('hl_lines', []))[1:-1]
+    if hllines:
+        self.body.append('\n' + r'\fvset{hllines={, %s,}}%%' % hllines)
+    self.body.append('\n' + hlcode + '\n')
+    if hllines:
+        self.body.append(r'\sphinxresetverbatimhllines' + '\n')
+    raise nodes.SkipNode
+
+
+class ParsedCodeBlock(CodeBlock):
+    """
+    The ``parsed-code-block`` directive.
+
+    Accepts the same options as the ``code-block`` directive, and creates the same nodes as it
+    does, except that the contents are parsed for inline markup into a `parsed_code_block`. The
+    node is created directly, instead of first creating the `literal_block` of a ``code-block``
+    and converting it, since that doubles the cost of reading code blocks.
+
+    For the builders listed in :confval:`parsed_codeblock_lazy_builders`, the contents are not
+    parsed at all: a `literal_block` of the raw reStructuredText is created instead, and the
+    document is read again once a builder that needs the markup is run (see
+    :py:func:`get_unrecorded_docs`).
+    """
+    def run(self) -> list[nodes.Node]:
+        document = self.state.document
+        code = '\n'.join(self.content)
+        location = self.state_machine.get_source_and_line(self.lineno)
+
+        # Same as for a code-block
+        linespec = self.options.get('emphasize-lines')
+        if linespec:
+            try:
+                nlines = len(self.content)
+                hl_lines = parselinenos(linespec, nlines)
+                if any(i >= nlines for i in hl_lines):
+                    LOGGER.warning(__('line number spec is out of range(1-%d): %r') %
+                                   (nlines, self.options['emphasize-lines']),
+                                   location=location)
+
+                hl_lines = [x + 1 for x in hl_lines if x < nlines]
+            except ValueError as err:
+                return [document.reporter.warning(err, line=self.lineno)]
+        else:
+            hl_lines = None
+
+        if 'dedent' in self.options:
+            lines = dedent_lines(code.splitlines(True), self.options['dedent'], location=location)
+            code = ''.join(lines)
+
+        node = self.create_node(code)
+
+        if 'linenos' in self.options or 'lineno-start' in self.options:
+            node['linenos'] = True
+        node['classes'] += self.options.get('class', [])
+        node['force'] = 'force' in self.options
+        node['language'] = (self.arguments[0] if self.arguments
+                            else self.env.temp_data.get('highlight_language')
+                            or self.config.highlight_language)
+
+        extra_args = node['highlight_args'] = {}
+        if hl_lines is not None:
+            extra_args['hl_lines'] = hl_lines
+        if 'lineno-start' in self.options:
+            extra_args['linenostart'] = self.options['lineno-start']
+        self.set_source_info(node)
+
+        caption = self.options.get('caption')
         if caption:
-            custom_node.protect_children()  # Necessary to work with the container
-            custom_node = container_wrapper(self, custom_node, caption)
+            try:
+                node = container_wrapper(self, node, caption)
+            except ValueError as exc:
+                return [document.reporter.warning(exc, line=self.lineno)]
+
+        self.add_name(node)
+        return [node]
 
-        return [custom_node]
+    def create_node(self, code: str) -> nodes.literal_block:
+        """
+        Parses the contents for inline markup and creates the node for them.
+
+        Parameters
+        ----------
+        code
+            The contents of the directive.
+
+        Returns
+        -------
+        node
+            The `parsed_code_block`, or a `literal_block` if there is no markup or the contents are
+            not to be parsed.
+        """
+        if getattr(self.env, '_parsed_codeblock_lazy', False):
+            return nodes.literal_block(code, code, parsed_codeblock_lazy=True)
+
+        text_nodes, messages = self.state.inline_text(code, self.lineno)
+        if all(isinstance(text_node, nodes.Text) for text_node in text_nodes):
+            # Without any markup, the code block is highlighted by Sphinx like any other (which
+            # requires the rawsource to be the same as the text)
+            text = ''.join(text_node.astext() for text_node in text_nodes)
+            return nodes.literal_block(text, text)
+
+        return parsed_code_block(code, '', *text_nodes)
+
+
+class ParsedLiteralInclude(ParsedCodeBlock):
+    """
+    The ``parsed-literalinclude`` directive.
+
+    Same as ``parsed-code-block``, except that the contents are read from a file, which is parsed
+    for inline markup the same way. Supports the ``lines``, ``start-after``, ``end-before``,
+    ``pyobject``, ``encoding`` and ``language`` options of ``literalinclude``, see
+    :py:func:`read_include`.
+    """
+    has_content = False
+    required_arguments = 1
+    optional_arguments = 0
+    final_argument_whitespace = True
+    option_spec = {
+        **ParsedCodeBlock.option_spec,
+        'language': directives.unchanged_required,
+        'encoding': directives.encoding,
+        'pyobject': directives.unchanged_required,
+        'lines': directives.unchanged_required,
+        'start-after': directives.unchanged_required,
+        'end-before': directives.unchanged_required,
+    }
+
+    def run(self) -> list[nodes.Node]:
+        document = self.state.document
+        if not document.settings.file_insertion_enabled:
+            return [document.reporter.warning('File insertion disabled', line=self.lineno)]
+
+        try:
+            rel_filename, filename = self.env.relfn2path(self.arguments[0])
+            self.env.note_dependency(rel_filename)
+
+            stat = os.stat(filename)
+            linespec = self.options.get('lines')
+            text, n_lines = read_include(str(filename), stat.st_mtime_ns, stat.st_size,
+                                         self.options.get('encoding', self.config.source_encoding),
+                                         self.options.get('pyobject'),
+                                         self.options.get('start-after'),
+                                         self.options.get('end-before'),
+                                         linespec)
+        except Exception as exc:
+            # Same as literalinclude
+            return [document.reporter.warning(exc, line=self.lineno)]
+
+        if linespec and any(i >= n_lines for i in parselinenos(linespec, n_lines)):
+            LOGGER.warning(__('line number spec is out of range(1-%d): %r') % (n_lines, linespec),
+                           location=self.state_machine.get_source_and_line(self.lineno))
+
+        self.content = StringList(text.rstrip('\n').split('\n'), source=str(filename))
+        self.arguments = [self.options['language']] if 'language' in self.options else []
+        return super().run()
+
+
+def _line_starts(data: bytes | mmap.mmap | str,
+                 start: int,
+                 end: int,
+                 newline: bytes | str) -> list[int]:
+    """Finds the offsets of the starts of the lines of ``data`` between ``start`` and ``end``."""
+    if start >= end:
+        return []
+
+    starts = [start]
+    position = data.find(newline, start, end)
+    while 0 <= position < end - 1:
+        starts.append(position + 1)
+        position = data.find(newline, position + 1, end)
+
+    return starts
+
+
+def _select_include(data: bytes | mmap.mmap | str,
+                    begin: int,
+                    newline: bytes | str,
+                    encode: Callable[[str], bytes | str],
+                    decode: Callable[[bytes | mmap.mmap | str], str],
+                    path: str,
+                    pyobject: str | None,
+                    start_after: str | None,
+                    end_before: str | None,
+                    linespec: str | None) -> tuple[str, int]:
+    """
+    Applies the selections of `read_include` to the contents of a file, only ever decoding the
+    selected part. Works the same on the raw bytes and on the decoded text, starting at ``begin``.
+    """
+    end = len(data)
+
+    if pyobject:
+        # The whole file has to be parsed to find the object
+        tags = ModuleAnalyzer.for_string(decode(data[begin:]), '', path).find_tags()
+        if pyobject not in tags:
+            raise ValueError(__('Object named %r not found in include file %r') % (pyobject, path))
+        _, first, last = tags[pyobject]
+        starts = _line_starts(data, begin, end, newline)
+        begin, end = starts[first - 1], starts[last] if last < len(starts) else end
+
+    if start_after:
+        position = data.find(encode(start_after), begin, end)
+        if position < 0:
+            raise ValueError('start-after pattern not found: %s' % start_after)
+        position = data.find(newline, position, end)
+        begin = end if position < 0 else position + 1
+
+    if end_before:
+        # Same as Sphinx, the pattern is ignored on the first line
+        marker = encode(end_before)
+        first_line = data.find(newline, begin, end)
+        position = -1 if first_line < 0 else data.find(marker, first_line + 1, end)
+        if position < 0:
+            raise ValueError('end-before pattern not found: %s' % end_before)
+        end = data.rfind(newline, begin, position) + 1
+
+    starts = _line_starts(data, begin, end, newline)
+    n_lines = len(starts)
+    if not linespec:
+        return decode(data[begin:end]), n_lines
+
+    selected = [n for n in parselinenos(linespec, n_lines) if n < n_lines]
+    if not selected:
+        raise ValueError(__('Line spec %r: no lines pulled from include file %r') % (linespec, path))
+
+    starts.append(end)
+    return ''.join(decode(data[starts[n]:starts[n + 1]]) for n in selected), n_lines
+
+
+@lru_cache(maxsize=INCLUDE_CACHE_SIZE)
+def read_include(path: str,
+                 mtime: int,
+                 size: int,
+                 encoding: str = 'utf-8-sig',
+                 pyobject: str | None = None,
+                 start_after: str | None = None,
+                 end_before: str | None = None,
+                 linespec: str | None = None) -> tuple[str, int]:
+    """
+    Reads the part of a file selected by the options of ``parsed-literalinclude``, the same way as
+    the ``literalinclude`` directive does.
+
+    The file is memory-mapped and the selections are applied to its raw bytes, so that only the
+    selected part of the file is ever decoded into a string (except for ``pyobject``, which has to
+    parse the whole file). This is not possible for encodings in which the line breaks and the
+    patterns are not encoded the same as in ASCII (e.g. UTF-16), which are decoded whole instead.
+
+    The result is memoized; ``mtime`` and ``size`` are only used so that a file is read again
+    whenever it changes.
+
+    Parameters
+    ----------
+    path
+        The path to the file.
+    mtime
+        The modification time of the file, in nanoseconds.
+    size
+        The size of the file, in bytes.
+    encoding
+        The encoding of the file.
+    pyobject
+        The name of a Python object, e.g. a class, to select the definition of.
+    start_after
+        A pattern after the first line containing which the selection starts.
+    end_before
+        A pattern before the first line containing which (excluding the first line) the selection
+        ends.
+    linespec
+        The line numbers to select from what is left after the other selections, e.g. ``'1,3-5'``.
+
+    Returns
+    -------
+    text
+        The selected text, with universal newlines.
+    n_lines
+        The number of lines ``linespec`` was applied to.
+
+    Raises
+    ------
+    ValueError
+        If a selection cannot be made, e.g. because a pattern is not in the file.
+    OSError
+        If the file cannot be read.
+    UnicodeDecodeError
+        If the file is not in ``encoding``.
+    """
+    options = (path, pyobject, start_after, end_before, linespec)
+    sig = codecs.lookup(encoding).name == 'utf-8-sig'
+    marker_encoding = 'utf-8' if sig else encoding
+    if '\n\t *x'.encode(marker_encoding) != b'\n\t *x':
+        with open(path, encoding=encoding) as f:
+            return _select_include(f.read(), 0, '\n', str, str, *options)
+
+    with open(path, 'rb') as f:
+        # An empty file cannot be mapped
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            begin = 3 if sig and data[:3] == codecs.BOM_UTF8 else 0
+            text, n_lines = _select_include(data, begin, b'\n',
+                                            lambda text: text.encode(marker_encoding),
+                                            lambda chunk: chunk.decode(marker_encoding),
+                                            *options)
+        finally:
+            if size:
+                data.close()
+
+    return text.replace('\r\n', '\n').replace('\r', '\n'), n_lines
+
+
+def prerender_key(node: parsed_code_block, lang: str, linenos: bool | str, opts: dict) -> str:
+    """
+    Creates the key under which a `parsed_code_block` node is pre-rendered.
+
+    Unlike the keys of the on-disk cache, the key does not contain the rendered markup (which is
+    not available until the write phase), only the positions of the markup elements in the text.
+
+    Parameters
+    ----------
+    node
+        The `parsed_code_block` node.
+    lang
+        The language of the code block.
+    linenos
+        Whether (and how) to show line numbers.
+    opts
+        The options for the lexer.
+
+    Returns
+    -------
+    key
+        The key, see `DiskCache.make_key`.
+    """
+    return DiskCache.make_key(node.astext(), lang, sorted(opts.items()), linenos,
+                              node.get('force', False),
+                              sorted(node.get('highlight_args', {}).items()),
+                              [(start, end) for start, end, _ in markup_intervals(node)])
+
+
+_PRERENDER_HIGHLIGHTER: PygmentsBridge | None = None
+_PRERENDER_TOKEN_CACHE: DiskCache | None = None
+
+
+def _init_prerender_worker(highlighter: PygmentsBridge, token_cache: DiskCache | None) -> None:
+    global _PRERENDER_HIGHLIGHTER, _PRERENDER_TOKEN_CACHE
+    _PRERENDER_HIGHLIGHTER = highlighter
+    _PRERENDER_TOKEN_CACHE = token_cache
+
+
+def _prerender_chunk(jobs: list[tuple]) -> tuple[list[tuple], list]:
+    """
+    Highlights a chunk of code blocks in a worker process, see :py:func:`prerender_code_blocks`.
+
+    Parameters
+    ----------
+    jobs
+        The ``(key, segments, lang, opts, force, linenos, highlight_args, location)`` of each code
+        block, where ``segments`` are the ``(text, is_markup)`` of the children of the node.
+
+    Returns
+    -------
+    results
+        The ``(key, highlighted, lexer, merge_time, fallbacks)`` of each code block that could be
+        highlighted.
+    logs
+        The messages logged while highlighting, to be emitted by the main process.
+    """
+    results = []
+    collector = logging.LogCollector()
+    with collector.collect():
+        for key, segments, lang, opts, force, linenos, highlight_args, location in jobs:
+            children = [nodes.inline(text, text) if is_markup else nodes.Text(text)
+                        for text, is_markup in segments]
+            node = parsed_code_block('', '', *children)
+
+            record = BlockRecord('', None)
+            token = CURRENT_RECORD.set(record)
+            start = perf_counter()
+            try:
+                highlighted = highlight_parsed_block(
+                    _PRERENDER_HIGHLIGHTER, node, None, node.astext(), lang, opts=opts,
+                    force=force, location=location, token_cache=_PRERENDER_TOKEN_CACHE,
+                    formatter_class=PlaceholderHtmlFormatter, linenos=linenos, **highlight_args
+                )
+            except Exception as e:
+                # Left to be rendered in the write phase, which reports the error properly
+                LOGGER.debug(f'sphinx-parsed-codeblock: could not pre-render code block: {e}')
+                continue
+            finally:
+                CURRENT_RECORD.reset(token)
+
+            results.append((key, highlighted, record.lexer, perf_counter() - start,
+                            record.fallbacks))
+
+    logging.convert_serializable(collector.logs)
+    return results, collector.logs
+
+
+def note_read_docs(app: Sphinx, env: BuildEnvironment, docnames: list[str]) -> None:
+    """Remembers the documents being read, whose code blocks are to be pre-rendered."""
+    if app.config.parsed_codeblock_prerender:
+        app.builder._parsed_codeblock_read_docs = list(docnames)
+
+
+def prerender_code_blocks(app: Sphinx, env: BuildEnvironment) -> None:
+    """
+    Highlights the code blocks of the documents that have been read in a pool of processes,
+    before the write phase.
+
+    The markup cannot be rendered before the write phase (e.g. references are not resolved yet),
+    so the code blocks are highlighted with `PlaceholderHtmlFormatter`, and the pre-rendered HTML
+    is stored on the builder by the content of the code block. The visitor then only has to render
+    the markup and fill in the placeholders (see :py:func:`fill_placeholders`), which is cheap
+    compared to lexing and merging the markup.
+
+    Only the ``'tokens'`` engine of HTML builders is supported, and only where processes can be
+    forked.
+    """
+    docnames = getattr(app.builder, '_parsed_codeblock_read_docs', None)
+    app.builder._parsed_codeblock_read_docs = None
+    if (not docnames or app.builder.format != 'html'
+            or app.config.parsed_codeblock_engine != 'tokens'
+            or getattr(app.builder, 'highlighter', None) is None):
+        return
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        LOGGER.verbose('sphinx-parsed-codeblock: code blocks cannot be pre-rendered on this '
+                       'platform')
+        return
+
+    jobs = {}
+    for docname in docnames:
+        for node in env.get_doctree(docname).findall(parsed_code_block):
+            source = node.astext()
+            if '\x00' in source:
+                # Would be mistaken for a placeholder
+                continue
+
+            lang, linenos, opts = highlight_settings(app.config, node)
+            key = prerender_key(node, lang, linenos, opts)
+            segments = [(child.astext(), not isinstance(child, nodes.Text))
+                        for child in node.children]
+            jobs[key] = (key, segments, lang, opts, node.get('force', False), linenos,
+                         node.get('highlight_args', {}), (docname, node.line))
+
+    if not jobs:
+        return
+
+    n_workers = app.config.parsed_codeblock_prerender_workers
+    if not n_workers:
+        n_workers = app.parallel if app.parallel > 1 else os.cpu_count() or 1
+    n_workers = min(n_workers, len(jobs))
+
+    # A few chunks per worker, so that the work is balanced without much overhead per code block
+    jobs = list(jobs.values())
+    size = -(-len(jobs) // (n_workers * 4))
+    chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+    start = perf_counter()
+    prerendered = app.builder._parsed_codeblock_prerendered = {}
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_prerender_worker,
+                             initargs=(app.builder.highlighter,
+                                       getattr(app.builder, '_parsed_codeblock_token_cache', None))
+                             ) as executor:
+        for results, logs in executor.map(_prerender_chunk, chunks):
+            for log in logs:
+                LOGGER.handle(log)
+            for key, *result in results:
+                prerendered[key] = tuple(result)
+
+    LOGGER.verbose(f'sphinx-parsed-codeblock: pre-rendered {len(prerendered)} code blocks with '
+                   f'{n_workers} processes in {perf_counter() - start:.3f} s')
+
+
+def block_targets(node: parsed_code_block) -> frozenset[tuple[str, str, str]]:
+    """
+    Finds the targets referenced by the markup of a `parsed_code_block` node.
+
+    Parameters
+    ----------
+    node
+        The `parsed_code_block` node, before the references are resolved.
+
+    Returns
+    -------
+    targets
+        The ``(domain, type, target)`` of each cross-reference in the node.
+    """
+    return frozenset((xref.get('refdomain', ''), xref.get('reftype', ''), xref.get('reftarget', ''))
+                     for xref in node.findall(pending_xref))
+
+
+def _target_name(name: str) -> str:
+    """
+    Normalises the name of a target so that a reference and the object it resolves to have the same
+    name, even if the reference is relative (e.g. to the current module or document). Distinct
+    objects may share a name, which only ever causes unnecessary rewrites.
+    """
+    return re.split(r'[./]', name.lstrip('~.'))[-1].lower()
+
+
+def _index_targets(env: BuildEnvironment) -> dict[tuple[str, str], list[tuple]]:
+    """Indexes the objects of all the domains by the domain and the normalised name."""
+    index = {}
+    for domain in env.domains.values():
+        for name, dispname, type_, docname, anchor, _ in domain.get_objects():
+            index.setdefault((domain.name, _target_name(name)), []).append(
+                (name, dispname, type_, docname, anchor)
+            )
+
+    return index
+
+
+def _block_data(env: BuildEnvironment) -> dict[str, frozenset | None]:
+    if not hasattr(env, 'parsed_codeblock_blocks'):
+        env.parsed_codeblock_blocks = {}
+        env.parsed_codeblock_targets = {}
+    return env.parsed_codeblock_blocks
+
+
+def record_blocks(app: Sphinx, doctree: nodes.document) -> None:
+    """
+    Records the targets referenced by all the `parsed_code_block` nodes of the document just read.
+
+    The document is read again whenever its blocks change, so only the targets are needed for
+    deciding which documents to write again (see :py:func:`get_dependent_docs`), and they are
+    recorded for the whole document rather than for each block (which may come from an included
+    file, so neither its line nor its content identify it).
+
+    The code blocks that were not parsed (see :confval:`parsed_codeblock_lazy_builders`) cannot be
+    recorded, so the whole document is recorded as ``None`` instead.
+    """
+    if getattr(app.env, '_parsed_codeblock_lazy', False) and any(
+            node.get('parsed_codeblock_lazy') for node in doctree.findall(nodes.literal_block)):
+        _block_data(app.env)[app.env.docname] = None
+        return
+
+    _block_data(app.env)[app.env.docname] = frozenset().union(
+        *(block_targets(node) for node in doctree.findall(parsed_code_block))
+    )
+
+
+def purge_blocks(app: Sphinx, env: BuildEnvironment, docname: str) -> None:
+    """Forgets the code blocks of a document that is removed or about to be read again."""
+    _block_data(env).pop(docname, None)
+
+
+def merge_blocks(app: Sphinx,
+                 env: BuildEnvironment,
+                 docnames: set[str],
+                 other: BuildEnvironment) -> None:
+    """Merges the code blocks recorded by a parallel read worker."""
+    data, other_data = _block_data(env), _block_data(other)
+    for docname in docnames:
+        if docname in other_data:
+            data[docname] = other_data[docname]
+
+
+def get_unrecorded_docs(app: Sphinx,
+                        env: BuildEnvironment,
+                        added: set[str],
+                        changed: set[str],
+                        removed: set[str]) -> list[str]:
+    """
+    Finds the documents read without the code blocks being recorded (e.g. by an older version of the
+    extension), which have to be read again for their dependencies to be tracked.
+
+    The documents whose code blocks were not parsed for markup (see
+    :confval:`parsed_codeblock_lazy_builders`) also have to be read again, unless the current
+    builder does not need the markup either.
+    """
+    data = _block_data(env)
+    lazy = getattr(env, '_parsed_codeblock_lazy', False)
+    return [docname for docname in env.all_docs
+            if docname not in removed
+            and not (isinstance(data.get(docname), frozenset)
+                     or (lazy and docname in data and data[docname] is None))]
+
+
+def get_dependent_docs(app: Sphinx, env: BuildEnvironment) -> list[str]:
+    """
+    Finds the documents that have to be written again because a target referenced by one of their
+    code blocks has changed, e.g. the title of a section linked to by ``:ref:`` was edited in
+    another document.
+
+    Each target is summarised by the objects it may resolve to (their documents, anchors and
+    display names); the summaries from the previous build are kept in the environment, so only
+    the documents whose targets actually changed are written again.
+    """
+    data = _block_data(env)
+    targets = frozenset().union(*(blocks for blocks in data.values() if blocks is not None))
+    if not targets:
+        env.parsed_codeblock_targets = {}
+        return []
+
+    index = _index_targets(env)
+    signatures = {target: DiskCache.make_key(sorted(index.get((target[0], _target_name(target[2])),
+                                                              [])))
+                  for target in targets}
+
+    old = env.parsed_codeblock_targets
+    changed = {target for target, signature in signatures.items() if old.get(target) != signature}
+    env.parsed_codeblock_targets = signatures
+
+    if not changed:
+        return []
+
+    return [docname for docname, blocks in data.items()
+            if blocks is not None and not changed.isdisjoint(blocks)]
+
+
+def init_lazy_parsing(app: Sphinx) -> None:
+    """Decides whether the code blocks read by this builder are parsed for markup, see
+    :confval:`parsed_codeblock_lazy_builders`."""
+    app.env._parsed_codeblock_lazy = app.builder.name in app.config.parsed_codeblock_lazy_builders
+
+
+def init_cache(app: Sphinx) -> None:
+    """Creates the caches used when rendering code blocks and the report, if enabled."""
+    if app.config.parsed_codeblock_cache:
+        directory = Path(app.doctreedir) / 'parsed_codeblock_cache'
+        app.builder._parsed_codeblock_cache = DiskCache(directory,
+                                                        app.config.parsed_codeblock_cache_size)
+
+    if app.config.parsed_codeblock_token_cache:
+        directory = Path(app.doctreedir) / 'parsed_codeblock_tokens'
+        app.builder._parsed_codeblock_token_cache = DiskCache(
+            directory, app.config.parsed_codeblock_token_cache_size
+        )
+
+    if app.config.parsed_codeblock_markup_cache:
+        app.builder._parsed_codeblock_markup_cache = LRUCache(
+            app.config.parsed_codeblock_markup_cache_size
+        )
+
+    if app.config.parsed_codeblock_report:
+        app.builder._parsed_codeblock_report = BuildReport(
+            Path(app.doctreedir) / 'parsed_codeblock_report', app.config.parsed_codeblock_report
+        )
+
+    if app.config.parsed_codeblock_dedup:
+        app.builder._parsed_codeblock_rendered = LRUCache(app.config.parsed_codeblock_dedup_size)
+        app.builder._parsed_codeblock_reused = ReuseCounter(
+            Path(app.doctreedir) / 'parsed_codeblock_dedup'
+        )
+
+    app.builder._parsed_codeblock_prerendered = {}
+    app.builder._parsed_codeblock_lexer_cache = LRUCache(LEXER_CACHE_SIZE)
+    app.builder._parsed_codeblock_guessed_lexer_cache = LRUCache(GUESSED_LEXER_CACHE_SIZE)
+
+
+def evict_cache(app: Sphinx, exception: Exception | None) -> None:
+    """Shrinks the on-disk caches of rendered code blocks and of tokens down to their maximum size,
+    writes the report and logs the statistics of the in-memory caches."""
+    for name, attribute in (('cache', '_parsed_codeblock_cache'),
+                            ('token cache', '_parsed_codeblock_token_cache')):
+        cache = getattr(app.builder, attribute, None)
+        if cache is not None and exception is None:
+            n_evicted = cache.evict()
+            if n_evicted:
+                LOGGER.verbose(f'sphinx-parsed-codeblock: evicted {n_evicted} code blocks from '
+                               f'{name}')
+
+    report = getattr(app.builder, '_parsed_codeblock_report', None)
+    if report is not None:
+        report.write(app.config.parsed_codeblock_report_top)
+
+    reused = getattr(app.builder, '_parsed_codeblock_reused', None)
+    if reused is not None:
+        n_reused = reused.collect()
+        if n_reused:
+            LOGGER.info(f'sphinx-parsed-codeblock: reused {n_reused} identical code blocks instead '
+                        f'of rendering them again')
+
+    for name, attribute in (('markup', '_parsed_codeblock_markup_cache'),
+                            ('lexer', '_parsed_codeblock_lexer_cache'),
+                            ('guessed lexer', '_parsed_codeblock_guessed_lexer_cache')):
+        cache = getattr(app.builder, attribute, None)
+        if cache is not None:
+            LOGGER.verbose(f'sphinx-parsed-codeblock: {name} cache hits: {cache.hits}, '
+                           f'misses: {cache.misses}')
 
 
 def setup(app: Sphinx) -> dict[str, str | bool]:
     """The main function - sets up the extension."""
     app.add_directive('parsed-code-block', ParsedCodeBlock)
+    app.add_directive('parsed-literalinclude', ParsedLiteralInclude)
+    app.add_config_value('parsed_codeblock_engine', 'tokens', 'html',
+                         types=ENUM('tokens', 'lines'))
+    app.add_config_value('parsed_codeblock_cache', False, '', types=[bool])
+    app.add_config_value('parsed_codeblock_cache_size', 64 * 1024 * 1024, '', types=[int])
+    app.add_config_value('parsed_codeblock_token_cache', False, '', types=[bool])
+    app.add_config_value('parsed_codeblock_token_cache_size', 64 * 1024 * 1024, '', types=[int])
+    app.add_config_value('parsed_codeblock_markup_cache', 'document', '',
+                         types=ENUM('document', 'build', None))
+    app.add_config_value('parsed_codeblock_markup_cache_size', 4096, '', types=[int])
+    app.add_config_value('parsed_codeblock_dedup', True, '', types=[bool])
+    app.add_config_value('parsed_codeblock_dedup_size', 1024, '', types=[int])
+    app.add_config_value('parsed_codeblock_stream_threshold', 20_000, '', types=[int])
+    app.add_config_value('parsed_codeblock_stream_chunk_size', 1000, '', types=[int])
+    app.add_config_value('parsed_codeblock_time_budget', None, '', types=[int, float, type(None)])
+    app.add_config_value('parsed_codeblock_budget_fallback', 'highlight', '',
+                         types=ENUM('highlight', 'literal'))
+    app.add_config_value('parsed_codeblock_report', None, '', types=ENUM('json', 'csv', None))
+    app.add_config_value('parsed_codeblock_report_top', 10, '', types=[int])
+    app.add_config_value('parsed_codeblock_lazy_builders', [], '', types=[list, tuple])
+    app.add_config_value('parsed_codeblock_prerender', False, '', types=[bool])
+    app.add_config_value('parsed_codeblock_prerender_workers', None, '', types=[int, type(None)])
+
+    app.connect('builder-inited', init_lazy_parsing)
+    app.connect('builder-inited', init_cache)
+    app.connect('build-finished', evict_cache)
+    app.connect('env-before-read-docs', note_read_docs)
+    app.connect('env-updated', prerender_code_blocks)
+    app.connect('doctree-read', record_blocks)
+    app.connect('env-purge-doc', purge_blocks)
+    app.connect('env-merge-info', merge_blocks)
+    app.connect('env-get-outdated', get_unrecorded_docs)
+    app.connect('env-get-updated', get_dependent_docs)
 
     app.add_node(parsed_code_block,
-                 html=(visit_parsed_code_block, depart_parsed_code_block))
+                 html=(visit_parsed_code_block, depart_parsed_code_block),
+                 latex=(visit_parsed_code_block_latex, depart_parsed_code_block))
 
     return {
         'version': '0.1',
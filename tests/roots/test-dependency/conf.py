@@ -0,0 +1,4 @@
+extensions = ['sphinx_parsed_codeblock']
+
+# Set explicitly, otherwise the test app changes it and thus the whole config
+html_theme = 'basic'
@@ -0,0 +1,2 @@
+extensions = ['sphinx_parsed_codeblock']
+parsed_codeblock_lazy_builders = ['dummy']
@@ -0,0 +1,2 @@
+extensions = ['sphinx_parsed_codeblock']
+html_theme = 'basic'
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from sphinx_parsed_codeblock.cache import DiskCache, LRUCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskCache(tmp_path / 'cache', 100)
+
+
+def test_make_key():
+    key = DiskCache.make_key('text', 1, ('a', 'b'))
+
+    assert key == DiskCache.make_key('text', 1, ('a', 'b'))
+    assert key != DiskCache.make_key('text', 1, ('a', 'c'))
+    assert key != DiskCache.make_key('tex', 't1', ('a', 'b'))
+
+
+def test_get_missing(cache):
+    assert cache.get(DiskCache.make_key('missing')) is None
+
+
+def test_set_get(cache):
+    key = DiskCache.make_key('value')
+    cache.set(key, '<span>value</span>')
+
+    assert cache.get(key) == '<span>value</span>'
+    assert list(cache.directory.glob('*/*.tmp')) == []
+
+
+def test_set_overwrite(cache):
+    key = DiskCache.make_key('value')
+    cache.set(key, 'old')
+    cache.set(key, 'new')
+
+    assert cache.get(key) == 'new'
+
+
+def test_evict(cache):
+    keys = [DiskCache.make_key(i) for i in range(5)]
+    for i, key in enumerate(keys):
+        cache.set(key, 'x' * 40)
+        os.utime(cache._path(key), (i, i))
+
+    # Reading marks the value as recently used
+    cache.get(keys[0])
+
+    assert cache.evict() == 3
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[4]) is not None
+    assert all(cache.get(key) is None for key in keys[1:4])
+
+
+def test_evict_empty(cache):
+    assert cache.evict() == 0
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.get('a') == 1  # 'a' is now the most recently used
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_default():
+    cache = LRUCache(2)
+    cache.set('a', '')
+
+    assert cache.get('a', 'default') == ''
+    assert cache.get('b', 'default') == 'default'
+
+
+def test_lru_cache_clear():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (1, 1)
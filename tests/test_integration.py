@@ -1,5 +1,14 @@
+import json
+import os
 from pathlib import Path
+import time
+import tracemalloc
+
+from docutils import nodes
 import pytest
+from sphinx.util.parallel import parallel_available
+
+from sphinx_parsed_codeblock import sphinx_parsed_codeblock as spc
 
 try:
     from sphinx.testing.path import path
@@ -43,21 +52,19 @@ def clean_up(text: str) -> list[str]:
             continue
 
         if line:
-            if 'class="headerlink" href="#id1" title="' in line and 'ink to this code">' in line:
+            if 'class="headerlink" href="#' in line and 'ink to this code">' in line:
                 continue
             out.append(line)
 
     return out
 
 
-@pytest.mark.sphinx("html", testroot="integration")
-def test_integration_html(app, status):
+def check_html(app, status):
     if SPHINX_PATH:
         root_dir = path(__file__).parent.abspath()
     else:
         root_dir = path(__file__).parent.absolute()
 
-    app.build()
     assert "build succeeded" in status.getvalue()  # Build succeeded
 
     result = clean_up((Path(app.srcdir) / "_build/html/test.html").read_text())
@@ -65,3 +72,347 @@ def test_integration_html(app, status):
 
     assert expected != []
     assert result == expected
+
+
+@pytest.mark.sphinx("html", testroot="integration")
+def test_integration_html(app, status):
+    app.build()
+    check_html(app, status)
+
+
+@pytest.mark.sphinx("html", testroot="integration",
+                    confoverrides={'parsed_codeblock_engine': 'lines'})
+def test_integration_html_lines_engine(app, status):
+    app.build()
+    check_html(app, status)
+
+
+@pytest.mark.sphinx("html", testroot="integration", confoverrides={'parsed_codeblock_cache': True})
+def test_integration_html_cache(app, status):
+    app.build()
+    check_html(app, status)
+
+    cache_dir = Path(app.doctreedir) / 'parsed_codeblock_cache'
+    cached = sorted(cache_dir.glob('*/*.cache'))
+    assert len(cached) == 3
+
+    app.build(force_all=True)
+    check_html(app, status)
+    assert sorted(cache_dir.glob('*/*.cache')) == cached
+
+
+@pytest.mark.sphinx("html", testroot="integration", confoverrides={'parsed_codeblock_report': 'json'})
+def test_integration_html_report(app, status):
+    app.build(force_all=True)
+    check_html(app, status)
+
+    path = Path(app.doctreedir) / 'parsed_codeblock_report' / 'parsed_codeblock_report.json'
+    records = json.loads(path.read_text())
+
+    assert len(records) == 3
+    assert all(record['document'] == 'test' for record in records)
+    assert all(record['lexer'] and record['markup'] and record['fallbacks'] == 0 for record in records)
+    assert records == sorted(records, key=lambda r: r['markup_time'] + r['merge_time'], reverse=True)
+    assert 'slowest code blocks' in status.getvalue()
+
+
+@pytest.mark.sphinx("html", testroot="integration",
+                    confoverrides={'parsed_codeblock_stream_threshold': 1,
+                                   'parsed_codeblock_stream_chunk_size': 2})
+def test_integration_html_streaming(app, status):
+    app.build(force_all=True)
+    check_html(app, status)
+
+
+@pytest.mark.sphinx("html", testroot="integration", freshenv=True,
+                    confoverrides={'parsed_codeblock_prerender': True,
+                                   'parsed_codeblock_prerender_workers': 2,
+                                   'parsed_codeblock_report': 'json'})
+def test_integration_html_prerender(app, status):
+    app.build(force_all=True)
+    check_html(app, status)
+
+    assert len(app.builder._parsed_codeblock_prerendered) == 3
+
+    path = Path(app.doctreedir) / 'parsed_codeblock_report' / 'parsed_codeblock_report.json'
+    records = json.loads(path.read_text())
+    assert len(records) == 3
+    assert all(record['lexer'] and record['fallbacks'] == 0 for record in records)
+
+
+def _doctree_memory(app, docname: str) -> int:
+    """Measures the memory taken by the doctree of a document with one 1000-markup block."""
+    tracemalloc.start()
+    try:
+        doctree = app.env.get_doctree(docname)
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    blocks = list(doctree.findall(spc.parsed_code_block))
+    assert len(blocks) == 1
+    assert len(blocks[0].children) == 2000
+    return memory
+
+
+@pytest.mark.sphinx('dummy', testroot='caption')
+def test_caption_does_not_duplicate_children(app):
+    app.build()
+
+    plain = _doctree_memory(app, 'plain')
+    captioned = _doctree_memory(app, 'captioned')
+
+    assert captioned < 1.2 * plain
+
+
+@pytest.mark.sphinx('html', testroot='no-markup')
+def test_no_markup_is_literal_block(app):
+    app.build()
+
+    doctree = app.env.get_doctree('index')
+    blocks = list(doctree.findall(nodes.literal_block))
+    assert not any(isinstance(block, spc.parsed_code_block) for block in blocks)
+    assert blocks[0].astext() == blocks[1].astext() == 'key: value\nescaped: ab'
+    assert doctree.ids['plain-block'] is blocks[0].parent
+
+    html = (Path(app.outdir) / 'index.html').read_text()
+    highlighted = html.split('<div class="highlight"><pre>')[1:]
+    assert len(highlighted) == 2
+    assert highlighted[0].split('</pre>')[0] == highlighted[1].split('</pre>')[0]
+
+
+def _write_target(srcdir: Path, title: str, text: str = 'Text.', name: str = 'target') -> None:
+    path = srcdir / f'{name}.rst'
+    heading = f'{name.capitalize()}\n{"=" * len(name)}'
+    path.write_text(f'{heading}\n\n.. _the-{name}:\n\n{title}\n{"-" * len(title)}\n\n{text}\n')
+    # Make sure that the change is noticed even on file systems with a coarse resolution
+    mtime = time.time() + 10
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.mark.sphinx('html', testroot='dependency', srcdir='dependency-changes')
+def test_changed_target_rewrites_dependent_docs(app, make_app, app_params):
+    srcdir = Path(app.srcdir)
+    app.build()
+    output = Path(app.outdir) / 'block.html'
+    assert 'First Title' in output.read_text()
+    assert 'First Other' in output.read_text()
+    assert app.env.parsed_codeblock_blocks['block'] == frozenset({('std', 'ref', 'the-target'),
+                                                                  ('std', 'ref', 'the-other')})
+
+    # The included code block is on the same line as the one in the document itself
+    _write_target(srcdir, 'Second Other', name='other')
+    app = make_app(*app_params.args, **app_params.kwargs)
+    app.build()
+    assert 'Second Other' in output.read_text()
+
+    # Only the title of the target section changes, but the code block shows it
+    _write_target(srcdir, 'Second Title')
+    app = make_app(*app_params.args, **app_params.kwargs)
+    app.build()
+    assert 'Second Title' in output.read_text()
+
+    # A change that does not affect the target does not rewrite the document
+    mtime = output.stat().st_mtime_ns
+    _write_target(srcdir, 'Second Title', 'More text.')
+    app = make_app(*app_params.args, **app_params.kwargs)
+    app.build()
+    assert output.stat().st_mtime_ns == mtime
+
+    # Removing a document forgets its code blocks
+    (srcdir / 'block.rst').unlink()
+    app = make_app(*app_params.args, **app_params.kwargs)
+    app.build()
+    assert 'block' not in app.env.parsed_codeblock_blocks
+
+
+@pytest.mark.sphinx('html', testroot='dependency', parallel=2)
+def test_parallel_read_merges_blocks(app):
+    app.build()
+
+    blocks = app.env.parsed_codeblock_blocks
+    assert set(blocks) == app.env.found_docs
+    assert len(blocks['block']) == 2
+    assert all(not blocks[docname] for docname in blocks if docname != 'block')
+
+
+@pytest.mark.sphinx('html', testroot='identical-blocks')
+def test_identical_blocks_rendered_once(app):
+    app.build()
+
+    # The link in sub/c is relative to a different directory, so its markup differs
+    rendered = app.builder._parsed_codeblock_rendered
+    assert (rendered.hits, rendered.misses) == (1, 2)
+    assert 'reused 1 identical code blocks' in app._status.getvalue()
+
+    def code(name):
+        return (Path(app.outdir) / f'{name}.html').read_text().split('<pre>')[1].split('</pre>')[0]
+
+    assert code('a') == code('b')
+    assert '../index.html' in code('sub/c')
+
+
+@pytest.mark.skipif(not parallel_available, reason='parallel builds are not supported')
+@pytest.mark.sphinx('html', testroot='identical-blocks', srcdir='identical-blocks-parallel',
+                    parallel=4)
+def test_identical_blocks_counted_in_parallel(app):
+    app.build()
+
+    # The documents after the first one are written by forked workers, one per document
+    assert app.builder.parallel_ok
+    assert 'reused 1 identical code blocks' in app._status.getvalue()
+    assert not list((Path(app.doctreedir) / 'parsed_codeblock_dedup').iterdir())
+
+
+@pytest.mark.sphinx('html', testroot='time-budget', freshenv=True)
+@pytest.mark.parametrize('fallback', ('highlight', 'literal'))
+def test_time_budget_fallback(make_app, app_params, fallback):
+    app = make_app(*app_params.args, **app_params.kwargs,
+                   confoverrides={'parsed_codeblock_time_budget': 0,
+                                  'parsed_codeblock_budget_fallback': fallback})
+    app.build()
+
+    # Identical code blocks do not silently reuse the fallback
+    warnings = app._warning.getvalue()
+    assert warnings.count('took longer than 0 s') == 3
+    assert 'index.rst:4' in warnings and 'index.rst:8' in warnings
+
+    html = (Path(app.outdir) / 'index.html').read_text()
+    parsed, parsed_again, plain, numbered = [block.split('</pre>')[0]
+                                             for block in html.split('<pre>')[1:]]
+    assert parsed == parsed_again
+    if fallback == 'highlight':
+        assert parsed == plain
+    else:
+        assert parsed == '<span></span>key: <em>value</em>\n'
+        assert numbered == ('<span></span><span class="linenos">1</span>key: <em>value</em>\n'
+                            '<span class="hll"><span class="linenos">2</span>other: x\n</span>')
+
+
+@pytest.mark.sphinx('latex', testroot='latex')
+def test_integration_latex(app):
+    app.build()
+
+    assert 'sphinx-parsed-codeblock' not in app._warning.getvalue()
+    tex = next(Path(app.outdir).glob('*.tex')).read_text()
+    code = tex.split(r'\begin{sphinxVerbatim}[commandchars=\\\{\}]')[1].split(r'\end{sphinxVerbatim}')[0]
+
+    assert r'\sphinxstyleemphasis{\PYG{l+lScalar+lScalarPlain}{value}' in code
+    assert r'\sphinxstylestrong{\PYG{l+lScalar+lScalarPlain}{multi}}' in code
+    assert r'\sphinxstylestrong{\PYG{l+lScalar+lScalarPlain}{line}}' in code
+    assert r'\sphinxhref{https://example.com}{\PYG{l+lScalar+lScalarPlain}{text}}' in code
+    # The text of the markup is also part of the name of its command, or its URL
+    assert r'\sphinxstyleemphasis{\PYG{l+lScalar+lScalarPlain}{a}}' in code
+    assert r'\sphinxstylestrong{\PYG{l+lScalar+lScalarPlain}{i}}' in code
+    assert r'\sphinxcode{\sphinxupquote{\PYG{l+lScalar+lScalarPlain}{e}}}' in code
+    assert r'\sphinxstyleemphasis{\PYG{l+lScalar+lScalarPlain}{b\PYGZcb{}}}' in code
+    assert r'{\PYG{l+lScalar+lScalarPlain}{https://example.com}}' in code
+    # Every line of the verbatim environment must be a balanced group
+    for line in code.strip().split('\n'):
+        assert line.count('{') == line.count('}')
+
+
+@pytest.mark.sphinx('html', testroot='token-cache')
+def test_token_cache_shared_by_builders(app, make_app, app_params, monkeypatch):
+    app.build()
+    assert list((Path(app.doctreedir) / 'parsed_codeblock_tokens').glob('*/*.cache'))
+    html = (Path(app.outdir) / 'index.html').read_text()
+
+    # Any further builder must not need to lex the code block again
+    from pygments.lexers.data import YamlLexer
+
+    def fail(*args, **kwargs):
+        raise AssertionError('lexed again')
+
+    monkeypatch.setattr(YamlLexer, 'get_tokens_unprocessed', fail)
+    for builder in ('dirhtml', 'latex'):
+        app = make_app(builder, **app_params.kwargs)
+        app.build()
+        assert 'sphinx-parsed-codeblock' not in app._warning.getvalue()
+
+    code = html.split('<pre>')[1].split('</pre>')[0]
+    assert code in (Path(app.outdir).parent / 'dirhtml' / 'index.html').read_text()
+
+
+@pytest.mark.sphinx('html', testroot='token-cache', srcdir='token-cache-streamed',
+                    confoverrides={'parsed_codeblock_stream_threshold': 1})
+def test_token_cache_skips_streamed_blocks(app):
+    app.build()
+    assert not list((Path(app.doctreedir) / 'parsed_codeblock_tokens').glob('*/*.cache'))
+    assert '<em>value</em>' in (Path(app.outdir) / 'index.html').read_text()
+
+
+@pytest.mark.sphinx('html', testroot='directive-options')
+def test_directive_options_match_code_block(app):
+    app.build()
+
+    doctree = app.env.get_doctree('index')
+    parsed, plain = doctree.findall(nodes.container)
+    assert isinstance(parsed[1], spc.parsed_code_block)
+    assert parsed[1].astext() == plain[1].astext() == 'key: value\nother: x'
+    assert parsed[0].astext() == plain[0].astext() == 'Caption'
+    assert doctree.ids['parsed'] is parsed
+
+    attributes = dict(parsed[1].attributes, ids=[], names=[])
+    assert attributes == dict(plain[1].attributes, ids=[], names=[])
+    assert (parsed[1].source, parsed[1].line) == (plain[1].source, plain[1].line - 12)
+
+
+@pytest.mark.sphinx('dummy', testroot='lazy-builders')
+def test_lazy_builders(app, make_app, app_params):
+    app.build()
+
+    doctree = app.env.get_doctree('index')
+    assert not list(doctree.findall(spc.parsed_code_block))
+    block, = doctree.findall(nodes.literal_block)
+    assert block.astext() == 'key: *value*\nlink: :ref:`the-target`'
+    assert doctree.ids['block'] is block
+    assert app.env.parsed_codeblock_blocks == {'index': None}
+
+    # Still not parsed for another lazy builder, but parsed as soon as the markup is needed
+    app = make_app('dummy', **app_params.kwargs)
+    app.build()
+    assert '0 added, 0 changed, 0 removed' in app._status.getvalue()
+
+    app = make_app('html', **app_params.kwargs)
+    app.build()
+    assert app.env.parsed_codeblock_blocks['index']
+    html = (Path(app.outdir) / 'index.html').read_text()
+    assert '<em>value</em>' in html
+    assert 'href="#the-target"' in html
+
+
+@pytest.mark.sphinx('html', testroot='literalinclude')
+def test_parsed_literalinclude(app, make_app, app_params):
+    hits = spc.read_include.cache_info().hits
+    app.build()
+    assert spc.read_include.cache_info().hits == hits + 1
+
+    doctree = app.env.get_doctree('index')
+    node = next(doctree.findall(spc.parsed_code_block))
+    assert node.astext() == 'key: value\nlink: docs'
+    assert node['highlight_args'] == {'hl_lines': [2]}
+
+    html = (Path(app.outdir) / 'index.html').read_text()
+    assert html.count('<em>value</em>') == 2
+    assert html.count('href="https://example.com"') == 2
+
+    # Editing the included file rewrites the document
+    included = Path(app.srcdir) / 'data.yaml'
+    included.write_text('# header\nkey: **value**\n')
+    mtime = time.time() + 10
+    os.utime(included, (mtime, mtime))
+
+    app = make_app(*app_params.args, **app_params.kwargs)
+    app.build()
+    html = (Path(app.outdir) / 'index.html').read_text()
+    assert html.count('<strong>value</strong>') == 2
+
+
+@pytest.mark.sphinx('html', testroot='literalinclude-errors')
+def test_parsed_literalinclude_errors(app):
+    app.build()
+
+    warnings = app._warning.getvalue()
+    assert 'missing.yaml' in warnings
+    assert 'line number spec is out of range(1-1)' in warnings
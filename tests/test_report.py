@@ -0,0 +1,55 @@
+import csv
+import json
+
+import pytest
+
+from sphinx_parsed_codeblock.report import BlockRecord, BuildReport, CURRENT_RECORD, warn_fallback
+
+
+def test_warn_fallback_counts():
+    warn_fallback('not recorded')
+
+    record = BlockRecord('index', 1)
+    token = CURRENT_RECORD.set(record)
+    try:
+        warn_fallback('recorded')
+        warn_fallback('recorded')
+    finally:
+        CURRENT_RECORD.reset(token)
+
+    assert record.fallbacks == 2
+
+
+def test_collect(tmp_path):
+    report = BuildReport(tmp_path)
+    report.add(BlockRecord('fast', 1, markup_time=0.1, merge_time=0.1))
+    report.add(BlockRecord('slow', 2, markup_time=0.1, merge_time=1.0))
+    (tmp_path / '1.jsonl').write_text(json.dumps({'document': 'other', 'line': 3, 'merge_time': 0.5}) + '\n')
+
+    records = report.collect()
+
+    assert [record.document for record in records] == ['slow', 'other', 'fast']
+    assert list(tmp_path.glob('*.jsonl')) == []
+
+
+def test_stale_records_removed(tmp_path):
+    (tmp_path / '1.jsonl').write_text(json.dumps({'document': 'stale', 'line': 3}) + '\n')
+
+    assert BuildReport(tmp_path).collect() == []
+
+
+@pytest.mark.parametrize('format', ['json', 'csv'])
+def test_write(tmp_path, format):
+    report = BuildReport(tmp_path, format)
+    report.add(BlockRecord('index', 1, 'YAML', 10, 2, 0.1, 0.2, 1))
+
+    path = report.write()
+
+    assert path == tmp_path / f'parsed_codeblock_report.{format}'
+    with open(path, newline='') as f:
+        rows = json.load(f) if format == 'json' else list(csv.DictReader(f))
+
+    assert len(rows) == 1
+    assert rows[0]['document'] == 'index'
+    assert float(rows[0]['merge_time']) == 0.2
+    assert int(rows[0]['fallbacks']) == 1
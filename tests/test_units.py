@@ -1,8 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import pickle
+
+import pygments
 import pytest
 
-from docutils.nodes import Text, emphasis, strong, literal, reference
-from pygments.formatters.html import escape_html
+from docutils.nodes import Text, emphasis, strong, literal, reference, inline, literal_block
+from pygments.formatters.html import escape_html, HtmlFormatter
+from pygments.lexers import get_lexer_by_name, TextLexer
+from pygments.token import Token
+from sphinx.highlighting import PygmentsBridge
 from sphinx_parsed_codeblock import sphinx_parsed_codeblock as spc
+from sphinx_parsed_codeblock.cache import LRUCache
 
 
 class MockVisitor:
@@ -18,10 +27,22 @@ class MockNode:
         visitor.body.extend(self.contents)
 
 
+class MockMarkup(MockNode):
+    def __init__(self, text: str, html: str):
+        super().__init__([html])
+        self.text = text
+
+    def astext(self):
+        return self.text
+
+
 class MockParent:
     def __init__(self, children: list):
         self.children = children
 
+    def astext(self):
+        return ''.join(child.astext() for child in self.children)
+
 
 @pytest.mark.parametrize('node,expected',
                          ((['this', 'is', 'a', 'sentence'], 'thisisasentence'),
@@ -34,6 +55,17 @@ def test_build_child_source(node, expected):
     result = spc.build_child_source(visitor, node)
 
     assert result == expected
+    assert visitor.body == ['some', 'preexisting', 'data']
+
+
+def test_build_children_source():
+    children = [MockNode(['this', 'is']), MockNode([]), MockNode(['one'])]
+    visitor = MockVisitor(['some', 'preexisting', 'data'])
+
+    result = spc.build_children_source(visitor, children)
+
+    assert result == ['thisis', '', 'one']
+    assert visitor.body == ['some', 'preexisting', 'data']
 
 
 @pytest.mark.parametrize(
@@ -211,6 +243,28 @@ def test_pygments_line_state_cut(source_str, n, expected):
     assert state.html_close == close
 
 
+def test_pygments_line_state_cut_past_end():
+    state = spc.PygmentsLineState('<span><b>text</b></span>')
+    state.cut(10)
+
+    assert state.text == ''
+    assert state.restore_span() == '</b></span>'
+
+
+@pytest.mark.parametrize(
+    'source_str,expected',
+    (
+        ('', []),
+        ('\n', []),
+        ('<span>text</span>\n', [0, 6, 10, 17]),
+        ('<span><b>text</b></span>', [0, 9, 13, 24]),
+        ('<span>a</span>raw<span class="b">c</span>\n', [0, 6, 7, 14, 17, 33, 34, 41]),
+    )
+)
+def test_pygments_line_state_scan(source_str, expected):
+    assert spc.PygmentsLineState._scan(source_str) == expected
+
+
 @pytest.mark.parametrize(
     'text,state,expected,error',
     (
@@ -358,3 +412,603 @@ def test_handle_markup(text, markup, state, expected, expected_result):
 
     assert result is expected_result
     assert actual == expected
+
+
+@pytest.mark.parametrize(
+    'children,expected',
+    (
+        ([], []),
+        ([Text('text')], []),
+        ([emphasis('**', '')], []),
+        ([emphasis('*value*', 'value')], [(0, 5, 0)]),
+        ([Text('text\n'), strong('**value**', 'value'), Text(' '), literal('``a``', 'a')],
+         [(5, 10, 1), (11, 12, 3)]),
+    )
+)
+def test_markup_intervals(children, expected):
+    expected = [(start, end, children[i]) for start, end, i in expected]
+    assert spc.markup_intervals(MockParent(children)) == expected
+
+
+@pytest.mark.parametrize(
+    'markup,text,expected',
+    (
+        ('<em>text</em>', 'text', ('<em>', '</em>')),
+        ('<em>a &amp; b</em>', 'a & b', ('<em>', '</em>')),
+        ('<b><span>te</span><span>xt</span></b>', 'text', ('<b>', '</b>')),
+        ('<b>text</b>', 'other', ('', '')),
+        # The text is also in the attributes of the tags
+        ('<a href="X">X</a>', 'X', ('<a href="X">', '</a>')),
+        ('<a class="reference external" href="https://a.b/c">https://a.b/c</a>', 'https://a.b/c',
+         ('<a class="reference external" href="https://a.b/c">', '</a>')),
+        ('<a href="#a-b" title="a &lt; b">a &lt; b</a>', 'a < b',
+         ('<a href="#a-b" title="a &lt; b">', '</a>')),
+    )
+)
+def test_extract_markup_wrapper(markup, text, expected):
+    assert spc.extract_markup_wrapper(markup, text) == expected
+
+
+def test_split_markup_memoized():
+    spc.split_markup.cache_clear()
+    markup = '<a class="reference internal" href="#x"><span class="std">a, b</span></a>'
+
+    for _ in range(3):
+        assert spc.split_markup(markup, 'a, b') == ('<a class="reference internal" href="#x">'
+                                                    '<span class="std">', '</span></a>')
+
+    assert spc.split_markup.cache_info().hits == 2
+
+
+def test_split_markup_spans_over_lines():
+    markup = '<b><span>a</span>\n<span>b</span></b>'
+    assert spc.split_markup(markup, 'a b') == ('<b>', '</b>')
+
+
+def test_extract_markup_wrapper_warns_every_time(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(spc, 'warn_fallback', warnings.append)
+
+    for _ in range(2):
+        assert spc.extract_markup_wrapper('<b>text</b>', 'other') == ('', '')
+
+    assert len(warnings) == 2
+
+
+TOKENS = [(Token.Name, 'foo'), (Token.Punctuation, ':'), (Token.Text, ' '),
+          (Token.Name, 'bar\nbaz'), (Token.Text, '\n')]
+
+
+@pytest.mark.parametrize(
+    'children,expected',
+    (
+        # No markup - same as Pygments
+        ([Text('foo: bar\nbaz')], None),
+        # Markup inside a span
+        ([MockMarkup('foo', '<em>foo</em>'), Text(': bar\nbaz')],
+         ['<span class="n"><em>foo</em></span><span class="p">:</span> <span class="n">bar</span>\n',
+          '<span class="n">baz</span>\n']),
+        ([Text('f'), MockMarkup('o', '<em>o</em>'), Text('o: bar\nbaz')],
+         ['<span class="n">f<em>o</em>o</span><span class="p">:</span> <span class="n">bar</span>\n',
+          '<span class="n">baz</span>\n']),
+        # Markup over multiple spans
+        ([MockMarkup('foo:', '<b>foo:</b>'), Text(' bar\nbaz')],
+         ['<b><span class="n">foo</span><span class="p">:</span></b> <span class="n">bar</span>\n',
+          '<span class="n">baz</span>\n']),
+        ([Text('fo'), MockMarkup('o:', '<b>o:</b>'), Text(' bar\nbaz')],
+         ['<span class="n">fo</span><b><span class="n">o</span><span class="p">:</span></b> '
+          '<span class="n">bar</span>\n',
+          '<span class="n">baz</span>\n']),
+        # Markup over multiple lines
+        ([Text('foo: '), MockMarkup('bar\nbaz', '<b>bar\nbaz</b>')],
+         ['<span class="n">foo</span><span class="p">:</span> <b><span class="n">bar</span></b>\n',
+          '<b><span class="n">baz</span></b>\n']),
+        # Markup that could not be resolved
+        ([MockMarkup('fox', '<b>fox</b>'), Text(': bar\nbaz')], None),
+        # Leading newlines stripped by the lexer
+        ([Text('\n\nf'), MockMarkup('o', '<em>o</em>'), Text('o: bar\nbaz')],
+         ['<span class="n">f<em>o</em>o</span><span class="p">:</span> <span class="n">bar</span>\n',
+          '<span class="n">baz</span>\n']),
+    )
+)
+def test_format_lines_with_markup(children, expected):
+    formatter = spc.MarkupHtmlFormatter(MockParent(children), MockVisitor([]))
+    if expected is None:
+        expected = [line for _, line in HtmlFormatter()._format_lines(TOKENS)]
+
+    result = [line for _, line in formatter._format_lines_with_markup(TOKENS)]
+
+    assert result == expected
+
+
+@pytest.mark.parametrize(
+    'children,expected',
+    (
+        ([Text('foo: bar\nbaz')], set()),
+        ([MockMarkup('foo', '<em>foo</em>'), Text(': bar\nbaz')], {0}),
+        ([Text('foo: bar\n\nbaz: '), MockMarkup('1', '<em>1</em>'), Text('\nq')], {2}),
+        ([Text('foo: '), MockMarkup('bar\nbaz', '<b>bar\nbaz</b>'), Text('\nq')], {0, 1}),
+        ([MockMarkup('a', 'a'), Text('\n'), MockMarkup('b', 'b'), Text('\n\n'), MockMarkup('c', 'c')],
+         {0, 1, 3}),
+    )
+)
+def test_markup_lines(children, expected):
+    node = MockParent(children)
+    assert spc.markup_lines(node.astext(), spc.markup_intervals(node)) == expected
+
+
+def test_insert_markup_skips_lines_without_markup(monkeypatch):
+    created = []
+
+    class CountingLineState(spc.PygmentsLineState):
+        def __init__(self, line):
+            created.append(line)
+            super().__init__(line)
+
+    monkeypatch.setattr(spc, 'PygmentsLineState', CountingLineState)
+
+    children = [Text('a: b\nc: '), MockMarkup('d', '<em>d</em>'), Text('\ne: f\n\ng: h')]
+    formatter = spc.MarkupHtmlFormatter(MockParent(children), MockVisitor([]), engine='lines')
+    lines = list(HtmlFormatter()._format_lines(get_lexer_by_name('yaml').get_tokens('a: b\nc: d\ne: f\n\ng: h')))
+
+    result = [line for _, line in formatter._insert_markup(iter(lines))]
+
+    assert len(created) == 1
+    assert '<em>d</em>' in result[1]
+    assert [line for i, line in enumerate(result) if i != 1] == \
+           [line for i, (_, line) in enumerate(lines) if i != 1]
+
+
+@pytest.mark.parametrize(
+    'first,second,same',
+    (
+        (emphasis('', 'value'), emphasis('', 'value'), True),
+        (emphasis('', 'value'), emphasis('', 'other'), False),
+        (emphasis('', 'value'), strong('', 'value'), False),
+        (reference('', 'value', refuri='#a'), reference('', 'value', refuri='#a'), True),
+        (reference('', 'value', refuri='#a'), reference('', 'value', refuri='#b'), False),
+        (reference('', '', inline('', 'value', classes=['std'])),
+         reference('', '', inline('', 'value', classes=['std'])), True),
+        (reference('', '', inline('', 'value', classes=['std'])),
+         reference('', '', inline('', 'value', classes=['xref'])), False),
+    )
+)
+def test_markup_node_key(first, second, same):
+    key = spc.markup_node_key(first)
+
+    assert hash(key) is not None
+    assert (key == spc.markup_node_key(second)) is same
+
+
+class MockTranslator(MockVisitor):
+    def __init__(self, scope, source='doc.rst'):
+        super().__init__([])
+        self.builder = MockVisitor([])
+        self.builder._parsed_codeblock_markup_cache = LRUCache(10)
+        self.config = MockVisitor([])
+        self.config.parsed_codeblock_markup_cache = scope
+        self.document = {'source': source}
+
+
+class CountingEmphasis(emphasis):
+    walks = 0
+
+    def walkabout(self, visitor: MockVisitor):
+        CountingEmphasis.walks += 1
+        visitor.body.append(f'<em>{self.astext()}</em>')
+
+
+@pytest.mark.parametrize('scope,walks', (('document', 3), ('build', 2)))
+def test_render_markup_memoized(scope, walks):
+    CountingEmphasis.walks = 0
+    children = [CountingEmphasis('', 'a'), Text(' '), CountingEmphasis('', 'b'),
+                CountingEmphasis('', 'a')]
+    visitor = MockTranslator(scope)
+
+    assert spc.render_markup(visitor, MockParent(children)) == ['<em>a</em>', '<em>b</em>', '<em>a</em>']
+
+    visitor.document = {'source': 'other.rst'}
+    assert spc.render_markup(visitor, MockParent(children[:1])) == ['<em>a</em>']
+
+    assert CountingEmphasis.walks == walks
+    assert visitor.body == []
+
+
+def make_parsed_code_block(n: int = 3) -> spc.parsed_code_block:
+    node = spc.parsed_code_block('', '', language='yaml')
+    for i in range(n):
+        node += Text(f'key_{i}: ')
+        node += emphasis('', f'value_{i}')
+        node += reference('', '', inline('', f'link_{i}', classes=['std']), refuri=f'#{i}')
+        node += Text('\n')
+    node += strong('', '')
+    return node
+
+
+def test_parsed_code_block_pickle_roundtrip():
+    node = make_parsed_code_block()
+    result = pickle.loads(pickle.dumps(node))
+
+    assert 'children' not in result.__dict__
+    assert result.astext() == node.astext()
+    assert 'children' not in result.__dict__  # astext does not need the children
+
+    assert result.pformat() == node.pformat()
+    assert result['language'] == 'yaml'
+    assert all(child.parent is result for child in result.children)
+    assert pickle.loads(pickle.dumps(result)).pformat() == node.pformat()
+
+
+def test_parsed_code_block_pickle_compact():
+    node = make_parsed_code_block(100)
+    children = node.children
+    compact = len(pickle.dumps(node))
+
+    node.__dict__['children'] = children
+    node.__class__ = literal_block
+    full = len(pickle.dumps(node))
+
+    assert compact < full
+
+
+def test_parsed_code_block_deepcopy():
+    node = make_parsed_code_block()
+    result = pickle.loads(pickle.dumps(node))
+
+    assert result.deepcopy().pformat() == node.pformat()
+    assert copy.deepcopy(result).pformat() == node.pformat()
+
+
+def test_highlight_parsed_block_does_not_modify_state():
+    bridge = PygmentsBridge('html')
+    formatter = bridge.formatter
+    node = make_parsed_code_block()
+    node['highlight_args'] = {'hl_lines': [1]}
+    markup = [escape_html(child.astext()) for _, _, child in spc.markup_intervals(node)]
+
+    result = spc.highlight_parsed_block(bridge, node, None, node.astext(), 'yaml', markup=markup,
+                                        **node['highlight_args'])
+
+    assert bridge.formatter is formatter
+    assert node['highlight_args'] == {'hl_lines': [1]}
+    assert '<span class="hll">' in result
+
+    with ThreadPoolExecutor(4) as executor:
+        results = executor.map(
+            lambda _: spc.highlight_parsed_block(bridge, node, None, node.astext(), 'yaml',
+                                                 markup=markup, **node['highlight_args']),
+            range(16)
+        )
+        assert all(r == result for r in results)
+
+
+def test_highlight_parsed_block_error_leaves_highlighter():
+    bridge = PygmentsBridge('html')
+    formatter = bridge.formatter
+    node = make_parsed_code_block()
+
+    with pytest.raises(AttributeError):  # no visitor to render the markup with
+        spc.highlight_parsed_block(bridge, node, None, node.astext(), 'yaml')
+
+    assert bridge.formatter is formatter
+
+
+def test_get_lexer_cached():
+    bridge = PygmentsBridge('html')
+    lexers, guessed_lexers = LRUCache(8), LRUCache(8)
+
+    def get(source, lang, opts=None):
+        return spc.get_lexer(bridge, source, lang, opts, lexers=lexers, guessed_lexers=guessed_lexers)
+
+    yaml = get('a: b', 'yaml')
+    assert get('c: d', 'yaml') is yaml
+    assert get('a: b', 'yaml', {'stripnl': False}) is not yaml
+    assert (lexers.hits, lexers.misses) == (1, 2)
+
+    assert get('>>> 1 + 1', 'default').name == 'Python console session'
+    assert get('1 + 1', 'default').name == 'Python'
+
+    guessed = get('#!/usr/bin/env python\nprint(1)', 'guess')
+    assert get('#!/usr/bin/env python\nprint(1)', 'guess') is guessed
+    assert get('#!/bin/bash\necho 1', 'guess') is not guessed
+    assert (guessed_lexers.hits, guessed_lexers.misses) == (1, 2)
+
+
+def test_get_lexer_unknown_not_cached():
+    bridge = PygmentsBridge('html')
+    lexers = LRUCache(8)
+
+    spc.get_lexer(bridge, 'a', 'not-a-language', lexers=lexers)
+    spc.get_lexer(bridge, 'a', 'not-a-language', lexers=lexers)
+
+    assert len(lexers) == 0
+
+
+def test_long_line_engines_match():
+    text = '[' + ', '.join(f'"value_{i}"' for i in range(2000))
+    node = spc.parsed_code_block('', '', Text(text + ', '), emphasis('', '"last"'), Text(']'),
+                                 language='json')
+    lexer = get_lexer_by_name('json')
+
+    tokens = pygments.highlight(node.astext(), lexer, spc.MarkupHtmlFormatter(node, None, 'tokens',
+                                                                             markup=['<em>"last"</em>']))
+    lines = pygments.highlight(node.astext(), lexer, spc.MarkupHtmlFormatter(node, None, 'lines',
+                                                                            markup=['<em>"last"</em>']))
+
+    assert lines == tokens
+    assert '<span class="s2"><em>"last"</em></span><span class="p">]</span>' in lines
+
+
+def test_lines_engine_resyncs_after_failed_line():
+    children = [Text('foo: baz '), MockMarkup('bar', '<em>bar</em>'), Text('\nbaz: '),
+                MockMarkup('qux', '<b>qux</b>'), Text('\nquux: 1')]
+    formatter = spc.MarkupHtmlFormatter(MockParent(children), MockVisitor([]), engine='lines')
+
+    # The first line does not match the node, so its markup cannot be merged
+    result = pygments.highlight('foo: bax bar\nbaz: qux\nquux: 1', get_lexer_by_name('yaml'),
+                                formatter)
+
+    assert '<em>' not in result
+    assert '<b>qux</b>' in result
+
+
+def test_lines_engine_leading_newlines():
+    children = [Text('\n\nfoo: 1\nbaz: '), MockMarkup('qux', '<b>qux</b>')]
+    node = MockParent(children)
+
+    for engine in ('tokens', 'lines'):
+        formatter = spc.MarkupHtmlFormatter(node, MockVisitor([]), engine=engine)
+        result = pygments.highlight(node.astext(), get_lexer_by_name('yaml'), formatter)
+        assert '<b>qux</b>' in result
+
+
+def test_engines_link_text_is_url():
+    html = '<a class="reference external" href="https://a.b/c">https://a.b/c</a>'
+    node = MockParent([MockMarkup('https://a.b/c', html), Text('\ny = 1')])
+
+    for engine in ('tokens', 'lines'):
+        formatter = spc.MarkupHtmlFormatter(node, MockVisitor([]), engine=engine)
+        result = pygments.highlight(node.astext(), get_lexer_by_name('python'), formatter)
+        assert '<a class="reference external" href="https://a.b/c"><span class="n">https</span>' in result
+
+
+def test_engines_single_text_token():
+    # The text lexer yields the whole block as one token, with a newline appended
+    node = MockParent([Text('foo: '), MockMarkup('qux', '<b>qux</b>'), Text('\nbar')])
+
+    formatter = spc.MarkupHtmlFormatter(node, MockVisitor([]), engine='tokens')
+    result = pygments.highlight(node.astext(), TextLexer(), formatter)
+    assert result == '<div class="highlight"><pre><span></span>foo: <b>qux</b>\nbar\n</pre></div>\n'
+
+    aligned = spc.align_markup(TextLexer().get_tokens(node.astext()), node.astext(),
+                               spc.markup_intervals(node))
+    assert [value for _, value, m in aligned if m == 0] == ['qux']
+
+
+@pytest.mark.parametrize(
+    'children,markup',
+    (
+        # Markup inside a span
+        ([emphasis('', 'foo'), Text(': bar\nbaz')], ['<em>foo</em>']),
+        # Markup over multiple spans
+        ([strong('', 'foo:'), Text(' bar\nbaz')], ['<strong>foo:</strong>']),
+        # Markup over multiple lines
+        ([Text('foo: '), reference('', 'bar\nbaz', refuri='#x')],
+         ['<a class="reference external" href="#x">bar\nbaz</a>']),
+        # Markup that could not be resolved
+        ([emphasis('', 'foo'), Text(': '), strong('', 'b<a>r')],
+         ['<em>foo</em>', '<strong>b&lt;a&gt;r</strong>']),
+    )
+)
+def test_placeholder_formatter_matches(children, markup):
+    node = spc.parsed_code_block('', '', *children, language='yaml')
+    lexer = get_lexer_by_name('yaml')
+    expected = pygments.highlight(node.astext(), lexer,
+                                  spc.MarkupHtmlFormatter(node, None, markup=markup, linenos=True))
+
+    result = pygments.highlight(node.astext(), lexer,
+                                spc.PlaceholderHtmlFormatter(node, linenos=True))
+
+    assert '\x00' in result
+    assert spc.fill_placeholders(result, node, markup) == expected
+
+
+def test_highlight_parsed_block_streaming():
+    bridge = PygmentsBridge('html')
+    node = make_parsed_code_block(10)
+    markup = [escape_html(child.astext()) for _, _, child in spc.markup_intervals(node)]
+    expected = spc.highlight_parsed_block(bridge, node, None, node.astext(), 'yaml', markup=markup)
+
+    body = ['<div>']
+    writer = spc.BodyWriter(body, 3)
+    result = spc.highlight_parsed_block(bridge, node, None, node.astext(), 'yaml', markup=markup,
+                                        outfile=writer)
+    writer.flush()
+
+    assert result is None
+    assert len(body) > 3
+    assert ''.join(body) == '<div>' + expected
+
+
+def test_highlight_parsed_block_streaming_retry():
+    bridge = PygmentsBridge('html')
+    node = spc.parsed_code_block('', '', Text('x = 1\n' * 10), emphasis('', 'y'), Text(' = $'))
+    markup = ['<em>y</em>']
+    expected = spc.highlight_parsed_block(bridge, node, None, node.astext(), 'python',
+                                          markup=markup)
+
+    # The error is only found after some of the lines have already been written
+    body = []
+    writer = spc.BodyWriter(body, 2)
+    spc.highlight_parsed_block(bridge, node, None, node.astext(), 'python', markup=markup,
+                               outfile=writer)
+    writer.flush()
+
+    assert ''.join(body) == expected
+
+
+def test_formatter_deadline():
+    node = make_parsed_code_block(2000)
+    markup = [escape_html(child.astext()) for _, _, child in spc.markup_intervals(node)]
+    lexer = get_lexer_by_name('yaml')
+
+    for engine in ('tokens', 'lines'):
+        formatter = spc.MarkupHtmlFormatter(node, None, engine, markup=markup, deadline=0.0)
+        with pytest.raises(spc.RenderBudgetExceeded):
+            pygments.highlight(node.astext(), lexer, formatter)
+
+    formatter = spc.MarkupHtmlFormatter(node, None, markup=markup, deadline=float('inf'))
+    assert pygments.highlight(node.astext(), lexer, formatter) == pygments.highlight(
+        node.astext(), lexer, spc.MarkupHtmlFormatter(node, None, markup=markup)
+    )
+
+
+def test_align_markup():
+    node = spc.parsed_code_block('', '', Text('a: '), emphasis('b\nc', 'b\nc'), Text('\n'),
+                                 language='yaml')
+    lexer = get_lexer_by_name('yaml')
+    aligned = list(spc.align_markup(lexer.get_tokens(node.astext()), node.astext(),
+                                    spc.markup_intervals(node)))
+
+    assert ''.join(value for _, value, _ in aligned) == node.astext()
+    assert ''.join(value for _, value, m in aligned if m == 0) == 'b\nc'
+    assert all(m in (-1, 0) for _, _, m in aligned)
+
+
+def test_latex_markup_tokens():
+    aligned = [(Token.Name, 'a', -1), (Token.Name, 'b\nc', 0), (Token.Text, '\n', -1)]
+
+    assert list(spc.latex_markup_tokens(aligned)) == [
+        (Token.Name, 'a'), (Token.Text, '\ue0000\ue001'), (Token.Name, 'b'),
+        (Token.Text, '\ue0000\ue002'), (Token.Name, '\n'), (Token.Text, '\ue0000\ue001'),
+        (Token.Name, 'c'), (Token.Text, '\ue0000\ue002'), (Token.Text, '\n'),
+    ]
+
+
+def test_highlight_parsed_block_latex():
+    bridge = PygmentsBridge('latex')
+    node = spc.parsed_code_block('', '', Text('key: '), emphasis('b\nc', 'b\nc'), language='yaml')
+    wrappers = [(r'\emph{', '}')]
+    result = spc.highlight_parsed_block_latex(bridge, node, node.astext(), 'yaml', wrappers)
+
+    assert result == bridge.highlight_block(node.astext(), 'yaml').replace(
+        r'\PYG{l+lScalar+lScalarPlain}{b}', r'\emph{\PYG{l+lScalar+lScalarPlain}{b}}',
+    ).replace(r'\PYG{l+lScalar+lScalarPlain}{c}', r'\emph{\PYG{l+lScalar+lScalarPlain}{c}}')
+
+
+def test_dump_tokens_roundtrip():
+    tokens = list(get_lexer_by_name('yaml').get_tokens('key: [value, "text"]\n'))
+    tokens.append((Token, 'root'))
+
+    assert spc.load_tokens(spc.dump_tokens(tokens)) == tokens
+
+
+def test_get_tokens_cached(tmp_path):
+    cache = spc.DiskCache(tmp_path, 1024 * 1024)
+    source = 'key: value\n'
+    lexer = get_lexer_by_name('yaml')
+    expected = list(lexer.get_tokens(source))
+
+    assert spc.get_tokens(lexer, source, 'yaml', token_cache=cache) == expected
+
+    class FailingLexer:
+        def get_tokens(self, text):
+            raise AssertionError('lexed again')
+
+    assert spc.get_tokens(FailingLexer(), source, 'yaml', token_cache=cache) == expected
+    with pytest.raises(AssertionError):
+        spc.get_tokens(FailingLexer(), source, 'yaml', force=True, token_cache=cache)
+
+
+INCLUDE_SOURCE = '''# START
+import os
+
+
+class Foo:
+    """Foo."""
+    def bar(self):
+        return os  # *os* `docs <https://docs.python.org/3/library/os.html>`_ END
+
+
+def baz():
+    pass
+# END
+'''
+
+
+@pytest.mark.parametrize('encoding,newline', (('utf-8-sig', '\n'), ('utf-8-sig', '\r\n'),
+                                              ('latin-1', '\n'), ('utf-16', '\n')))
+@pytest.mark.parametrize(
+    'options',
+    (
+        {},
+        {'lines': '2-4,7'},
+        {'lines': '3-'},
+        {'start-after': 'START'},
+        {'end-before': 'END'},
+        {'start-after': 'import', 'end-before': 'END', 'lines': '2,4'},
+        {'pyobject': 'Foo'},
+        {'pyobject': 'Foo.bar'},
+        {'pyobject': 'baz', 'lines': '1'},
+    )
+)
+def test_read_include_matches_literalinclude(tmp_path, encoding, newline, options):
+    from sphinx.config import Config
+    from sphinx.directives.code import LiteralIncludeReader
+
+    if encoding == 'utf-16' and 'pyobject' in options:
+        pytest.skip('literalinclude cannot parse Python files in UTF-16')
+
+    # With a byte order mark for the UTF encodings
+    path = tmp_path / 'source.py'
+    path.write_bytes(INCLUDE_SOURCE.replace('\n', newline).encode(encoding))
+
+    config = Config({'source_encoding': encoding})
+    expected, _ = LiteralIncludeReader(str(path), dict(options, encoding=encoding), config).read()
+
+    stat = path.stat()
+    text, _ = spc.read_include(str(path), stat.st_mtime_ns, stat.st_size, encoding,
+                               options.get('pyobject'), options.get('start-after'),
+                               options.get('end-before'), options.get('lines'))
+    assert text == expected
+
+
+@pytest.mark.parametrize('options,message', (({'start-after': 'MISSING'}, 'start-after'),
+                                             ({'end-before': 'START'}, 'end-before'),
+                                             ({'pyobject': 'Missing'}, 'Missing'),
+                                             ({'lines': '100-'}, 'no lines')))
+def test_read_include_errors(tmp_path, options, message):
+    path = tmp_path / 'source.py'
+    path.write_text(INCLUDE_SOURCE)
+    stat = path.stat()
+
+    with pytest.raises(ValueError, match=message):
+        spc.read_include(str(path), stat.st_mtime_ns, stat.st_size, 'utf-8',
+                         options.get('pyobject'), options.get('start-after'),
+                         options.get('end-before'), options.get('lines'))
+
+
+def test_read_include_empty_file(tmp_path):
+    path = tmp_path / 'empty.py'
+    path.write_text('')
+
+    assert spc.read_include(str(path), 0, 0) == ('', 0)
+
+
+@pytest.mark.parametrize(
+    'markup,text,expected',
+    (
+        (r'\sphinxstyleemphasis{a}', 'a', (r'\sphinxstyleemphasis{', '}')),
+        (r'\sphinxstylestrong{i}', 'i', (r'\sphinxstylestrong{', '}')),
+        (r'\sphinxcode{\sphinxupquote{e}}', 'e', (r'\sphinxcode{\sphinxupquote{', '}}')),
+        (r'\sphinxhref{https://example.com}{https://example.com}', 'https://example.com',
+         (r'\sphinxhref{https://example.com}{', '}')),
+        (r'\sphinxurl{https://example.com}', 'https://example.com', (r'\sphinxurl{', '}')),
+        (r'\sphinxstyleemphasis{b\}}', r'b\}', (r'\sphinxstyleemphasis{', '}')),
+        ('plain', 'plain', ('', '')),
+        (r'\sphinxstyleemphasis{a}\label{x}', 'a', None),
+        (r'\sphinxstyleemphasis{a}', 'b', None),
+    )
+)
+def test_split_latex_markup(markup, text, expected):
+    assert spc.split_latex_markup(markup, text) == expected